@@ -0,0 +1,73 @@
+#!/usr/bin/python2.4
+#
+# Copyright (C) 2006, 2007  Lars Wirzenius <liw@iki.fi>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Copy notes between note directories, SQLite databases and archives
+
+Usage: notetak-migrate SOURCE TARGET
+       notetak-migrate --shard DIRECTORY
+
+A TARGET ending in .sqlite is a SQLite database, anything else is a
+directory with one file per note. The SOURCE is not changed.
+
+If SOURCE or TARGET is an archive, a tar file (.tar, .tar.gz, .tgz,
+.tar.bz2) or a JSON-lines file (.jsonl), the notes are streamed one at a
+time (see stream_notes), without starting the GUI, and the throughput
+is reported. Notes imported into a directory or database replace those
+with the same ids; the others are kept.
+
+With --shard, the note files in DIRECTORY are moved, in place, into the
+fan-out layout of subdirectories (see DirectoryStorage.shard). This can
+be run again to finish an interrupted conversion.
+
+"""
+
+import sys
+import time
+
+from notetak import *
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.stderr.write("Usage: notetak-migrate SOURCE TARGET\n"
+                         "       notetak-migrate --shard DIRECTORY\n")
+        sys.exit(1)
+    if sys.argv[1] == "--shard":
+        count = DirectoryStorage(sys.argv[2]).shard()
+        print "Moved %d notes into subdirectories of %s." % (count, 
+                                                             sys.argv[2])
+        sys.exit(0)
+    source, target = sys.argv[1:]
+    storages = [open_archive(name) or open_storage(name) 
+                for name in (source, target)]
+    for storage in storages:
+        if not storage.available:
+            sys.stderr.write("%s needs a module that is not installed: "
+                             "sqlite3, pysqlite2, json or simplejson.\n" %
+                             storage.__class__.__name__)
+            sys.exit(1)
+    if open_archive(source) or open_archive(target):
+        started = time.time()
+        count, size = stream_notes(source, target)
+        duration = max(time.time() - started, 0.001)
+        print ("Copied %d notes (%d bytes) from %s to %s in %.1f s: "
+               "%.0f notes/s, %.2f MB/s." % 
+               (count, size, source, target, duration, count / duration,
+                size / duration / (1024 * 1024)))
+    else:
+        count = migrate(source, target)
+        print "Copied %d notes from %s to %s." % (count, source, target)
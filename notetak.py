@@ -22,10 +22,16 @@ This program was inspired by "Notational Velocity" for OS X.
 Lars Wirzenius <liw@iki.fi>
 """
 
+import array
 import inspect
 import logging
 import os
+import stat
+import StringIO
+import struct
 import sys
+import tarfile
+import threading
 import time
 
 import pygtk
@@ -36,6 +42,46 @@ import gtk
 import gtk.glade
 import pango
 
+try:
+    import multiprocessing
+except ImportError:
+    # Python 2.4 and 2.5 don't have multiprocessing; the process based
+    # search backend is then not available.
+    multiprocessing = None
+
+try:
+    from hashlib import md5
+except ImportError:
+    # Python 2.4 has no hashlib.
+    from md5 import new as md5
+
+try:
+    import sqlite3
+except ImportError:
+    try:
+        from pysqlite2 import dbapi2 as sqlite3
+    except ImportError:
+        # Without sqlite3 or pysqlite2, the SQLite storage is not
+        # available.
+        sqlite3 = None
+
+try:
+    import ctypes
+except ImportError:
+    # Python 2.4 has no ctypes; note directories are then watched for
+    # changes by polling.
+    ctypes = None
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        # Python 2.4 and 2.5 have no json; JSON-lines archives are then
+        # not available, unless simplejson is installed.
+        json = None
+
 
 NAME = "Notetak"
 VERSION = "0.17"
@@ -66,6 +112,8 @@ with this program; if not, write to the Free Software Foundation, Inc.,
 FONT = "Monospace"
 GCONFDIR = "/apps/NotetakDevelopment"
 
+EMPTY_DIGEST = md5("").hexdigest()
+
 
 # This is a kludge. Python 2.5 will include a uuid module.
 sys.path.append(os.path.dirname(GLADE))
@@ -73,6 +121,186 @@ import notetakuuid
 uuid = notetakuuid
 
 
+def id_from_filename(filename):
+    """Return the id of the note stored in a file"""
+    basename = os.path.basename(filename)
+    if basename.endswith(".note"):
+        return basename[:-len(".note")]
+    return basename
+
+
+def check_note_id(id):
+    """Raise ValueError if 'id' cannot safely name a note file
+    
+    Ids come from archives that may have been made anywhere, and are
+    used as file names, so they must not lead out of the directory.
+    
+    """
+    if (not id or id.startswith(".") or "/" in id or os.sep in id or
+        "\0" in id or "\n" in id):
+        raise ValueError("Bad note id: %s" % repr(id))
+    return id
+
+
+def temp_filename(filename):
+    """Return the name of the temporary file used to write 'filename'"""
+    dirname, basename = os.path.split(filename)
+    return os.path.join(dirname, ".%s.tmp" % basename)
+
+
+def is_temp_filename(basename):
+    """Is 'basename' the name of a temporary file made by write_file?"""
+    return basename.startswith(".") and basename.endswith(".tmp")
+
+
+def write_file(filename, data, mtime=None):
+    """Replace the contents of a file, without ever truncating it
+    
+    The data is written to a temporary file in the same directory,
+    which is flushed to disk and then renamed over the old file. After
+    a crash, the file has either the old or the new contents. The
+    permissions of the old file are kept. To make the rename itself
+    durable, call sync_directory afterwards; when writing many files,
+    once for all of them is enough.
+    
+    """
+
+    temp = temp_filename(filename)
+    try:
+        f = file(temp, "w")
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        if mtime is not None:
+            os.utime(temp, (mtime, mtime))
+        try:
+            st = os.stat(filename)
+        except OSError:
+            pass
+        else:
+            os.chmod(temp, stat.S_IMODE(st.st_mode))
+        os.rename(temp, filename)
+    except:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def make_parent_directory(filename):
+    """Create the directory a file is in, if it does not exist yet
+    
+    Each directory created is synced into its parent, so that a crash
+    cannot lose it along with the files written into it.
+    
+    """
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.isdir(dirname):
+        make_parent_directory(dirname)
+        try:
+            os.mkdir(dirname)
+        except OSError:
+            if not os.path.isdir(dirname):
+                raise
+        sync_directory(os.path.dirname(dirname) or ".")
+
+
+def sync_directory(dirname):
+    """Flush the changes to a directory, such as renames, to disk"""
+    try:
+        fd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        try:
+            os.fsync(fd)
+        except OSError:
+            # Some file systems cannot fsync a directory.
+            pass
+    finally:
+        os.close(fd)
+
+
+def map_in_threads(function, items, threads, batch_size, callback):
+    """Call function for each item in a pool of threads
+    
+    The results are passed to callback, in the caller's thread, in
+    lists of up to batch_size results, in the order of the items. At
+    most a few items per thread are being worked on, or waiting to be
+    passed on, at any one time. If function raises an exception, it is
+    raised again in the caller.
+    
+    """
+
+    items = list(items)
+    if threads <= 1:
+        for i in range(0, len(items), batch_size):
+            callback([function(item) for item in items[i:i + batch_size]])
+        return
+
+    window = threads * 4
+    condition = threading.Condition()
+    results = {}
+    state = {"next": 0, "collected": 0, "stopped": False}
+
+    def work():
+        condition.acquire()
+        try:
+            while True:
+                while (not state["stopped"] and state["next"] < len(items) and
+                       state["next"] - state["collected"] >= window):
+                    condition.wait()
+                if state["stopped"] or state["next"] >= len(items):
+                    return
+                i = state["next"]
+                state["next"] += 1
+                condition.release()
+                try:
+                    try:
+                        result = (True, function(items[i]))
+                    except:
+                        result = (False, sys.exc_info())
+                finally:
+                    condition.acquire()
+                results[i] = result
+                condition.notifyAll()
+        finally:
+            condition.release()
+
+    for i in range(min(threads, len(items))):
+        thread = threading.Thread(target=work)
+        thread.setDaemon(True)
+        thread.start()
+
+    try:
+        batch = []
+        for i in range(len(items)):
+            condition.acquire()
+            try:
+                while i not in results:
+                    condition.wait()
+                ok, result = results.pop(i)
+                state["collected"] = i + 1
+                condition.notifyAll()
+            finally:
+                condition.release()
+            if not ok:
+                raise result[0], result[1], result[2]
+            batch.append(result)
+            if len(batch) == batch_size:
+                callback(batch)
+                batch = []
+        if batch:
+            callback(batch)
+    finally:
+        condition.acquire()
+        state["stopped"] = True
+        condition.notifyAll()
+        condition.release()
+
+
 class Note:
 
     """An individual note
@@ -92,45 +320,115 @@ class Note:
     a specified period after the last change to this note. This can be
     used by external code to, for example, automatically save a note
     after the user has stopped editing it.
+
+    The text of a note is kept as a plain string. The GtkTextBuffer
+    needed for editing is only created when get_buffer is called, and
+    it can be released again with release_buffer, once nobody is
+    showing it. See BufferCache.
+
+    A note can also be loaded lazily, from meta data kept in a Catalog:
+    the text is then read from the file only when it is first needed.
+
+    Each individual edit can be reported to an edit callback, for
+    keeping a Journal. The edits are relative to the text whose digest
+    is in journal_base: the text of the file when it was loaded, or the
+    text most recently saved.
     
     """
 
-    def __init__(self):
-        self.id = str(uuid.uuid4())
+    def __init__(self, id=None):
+        # Notes loaded from storage get their id from there; only brand
+        # new notes need a new one. New ids are time-ordered, so that
+        # the notes sort by creation time, and are written close to
+        # each other in catalogs, shards and indexes.
+        if id is None:
+            id = str(uuid.uuid7())
+        self.id = id
         logging.debug("Created Note, id=%s" % self.id)
         self.buffer = None
+        self.handlers = []
+        self.pins = 0
+        self.buffer_cache = None
+        self.text = ""
+        self.title = ""
+        self.size = 0
+        self.filename = None
+        self.digest = None
+        self.journal_base = EMPTY_DIGEST
         self.mtime = None
         self.dirty = False
+        self.change_count = 0
         self.timeout_id = None
         self.timeout_length = None
         self.timeout_callback = None
         self.immediate_change_callback = None
+        self.edit_callback = None
 
     def load(self, filename):
         """Load note from disk into memory"""
 
+        self.set_id_from_filename(filename)
         logging.debug("Loading note %s from %s" % (self.id, filename))
-        f = file(filename, "r")
-        data = f.read()
-        f.close()
+        self.release_buffer(force=True)
+        self.filename = filename
+        self.read_text()
+        self.mtime = os.stat(filename).st_mtime
+
+    def load_lazily(self, filename, title, size, mtime, digest):
+        """Set up note from known meta data, without reading the file
         
-        basename = os.path.basename(filename)
-        if basename.endswith(".note"):
-            self.id = basename[:-len(".note")]
-        else:
-            self.id = basename
+        The text is read from the file the first time it is needed.
         
-        self.set_text(data)
-        self.mtime = os.stat(filename).st_mtime
+        """
+        self.set_id_from_filename(filename)
+        self.release_buffer(force=True)
+        self.filename = filename
+        self.text = None
+        self.title = title
+        self.size = size
+        self.mtime = mtime
+        self.digest = digest
+        self.journal_base = digest
+
+    def load_data(self, id, text, mtime):
+        """Set up note from data stored somewhere else than in a file"""
+        self.id = id
+        self.release_buffer(force=True)
+        self.filename = None
+        self.set_plain_text(text)
+        self.mtime = mtime
+        self.digest = md5(text).hexdigest()
+        self.journal_base = self.digest
+
+    def set_id_from_filename(self, filename):
+        """Set the id of the note from the name of its file"""
+        self.id = id_from_filename(filename)
+
+    def read_text(self):
+        """Read the text of the note from its file"""
+        f = file(self.filename, "r")
+        data = f.read()
+        f.close()
+        self.set_plain_text(data)
+        self.digest = md5(data).hexdigest()
+        self.journal_base = self.digest
+
+    def is_loaded(self):
+        """Is the text of the note in memory?"""
+        return self.buffer is not None or self.text is not None
 
     def save(self, filename):
-        """Save note from memory to disk"""
+        """Save note from memory to disk
+        
+        The file is replaced atomically, see write_file.
+        
+        """
 
         logging.debug("Saving note %s to %s" % (self.id, filename))        
-        f = file(filename, "w")
-        f.write(self.get_text())
-        f.close()
-        os.utime(filename, (self.mtime, self.mtime))
+        text = self.get_text()
+        write_file(filename, text, self.mtime)
+        self.digest = md5(text).hexdigest()
+        self.journal_base = self.digest
         self.dirty = False
 
     def remove(self, filename):
@@ -141,14 +439,58 @@ class Note:
             os.remove(filename)
 
     def get_buffer(self):
-        """Return the GtkTextBuffer for this note"""
+        """Return the GtkTextBuffer for this note, creating it if needed"""
+        if self.buffer is None:
+            text = self.get_text()
+            self.buffer = gtk.TextBuffer()
+            self.buffer.set_text(text)
+            start = self.buffer.get_start_iter()
+            self.buffer.place_cursor(start)
+            self.handlers = [
+                self.buffer.connect("insert-text", self.buffer_insert_text),
+                self.buffer.connect("delete-range", self.buffer_delete_range),
+                self.buffer.connect("changed", self.touch),
+                ]
+            self.text = None
+        if self.buffer_cache is not None:
+            self.buffer_cache.use(self)
         return self.buffer
 
+    def release_buffer(self, force=False):
+        """Forget the GtkTextBuffer, keeping the text as a plain string
+        
+        Unless 'force' is true, the buffer is not released if the note
+        is pinned. Return True if the note no longer has a buffer.
+        
+        """
+        if self.buffer is None:
+            return True
+        if self.pins > 0 and not force:
+            return False
+        self.set_plain_text(self.get_text())
+        for handler in self.handlers:
+            self.buffer.disconnect(handler)
+        self.buffer = None
+        self.handlers = []
+        return True
+
+    def pin(self):
+        """Prevent the buffer from being released, e.g., while shown"""
+        self.pins += 1
+
+    def unpin(self):
+        """Undo one call to pin"""
+        self.pins -= 1
+
+    def set_buffer_cache(self, buffer_cache):
+        """Set the BufferCache that limits how many buffers are kept"""
+        self.buffer_cache = buffer_cache
+
     def get_title(self):
         """Return title of note"""
         
         if self.buffer is None:
-            return ""
+            return self.title
         line0 = self.buffer.get_iter_at_line(0)
         line1 = self.buffer.get_iter_at_line(1)
         title = self.buffer.get_text(line0, line1)
@@ -160,20 +502,58 @@ class Note:
         """Return the entire contents of a note, including title"""
         
         if self.buffer is None:
-            return ""
+            if self.text is None:
+                self.read_text()
+            return self.text
         start, end = self.buffer.get_bounds()
         return self.buffer.get_text(start, end)
 
+    def set_plain_text(self, text):
+        """Set the text and meta data, without counting it as a change"""
+        self.text = text
+        self.title = text.split("\n", 1)[0]
+        self.size = len(text)
+
     def set_text(self, text):
         """Change the entire contents of a note, including first line/title"""
         
         if self.buffer is None:
-            self.buffer = gtk.TextBuffer()
-            self.buffer.connect("changed", self.touch)
-        self.buffer.set_text(text)
-        start = self.buffer.get_start_iter()
-        self.buffer.move_mark(self.buffer.get_insert(), start)
-        self.buffer.move_mark(self.buffer.get_selection_bound(), start)
+            self.set_plain_text(text)
+            if self.edit_callback:
+                self.edit_callback(self, "set", text)
+            self.touch()
+        else:
+            self.buffer.set_text(text)
+            start = self.buffer.get_start_iter()
+            self.buffer.move_mark(self.buffer.get_insert(), start)
+            self.buffer.move_mark(self.buffer.get_selection_bound(), start)
+
+    def replace_text(self, text, mtime):
+        """Replace the text with one changed outside the program
+        
+        Unlike set_text, this does not count as an edit: the note stays
+        as clean as it was, and the new text is not journaled. The
+        cursor stays where it was, as far as the new text allows.
+        
+        """
+        if self.buffer is None:
+            self.set_plain_text(text)
+        else:
+            insert = self.buffer.get_iter_at_mark(self.buffer.get_insert())
+            offset = insert.get_offset()
+            for handler in self.handlers:
+                self.buffer.handler_block(handler)
+            try:
+                self.buffer.set_text(text)
+            finally:
+                for handler in self.handlers:
+                    self.buffer.handler_unblock(handler)
+            self.buffer.place_cursor(self.buffer.get_iter_at_offset(offset))
+        self.digest = md5(text).hexdigest()
+        self.journal_base = self.digest
+        self.mtime = mtime
+        if self.immediate_change_callback:
+            self.immediate_change_callback(self)
 
     def now(self):
         """Return current time"""
@@ -184,78 +564,1728 @@ class Note:
         """Update the modification time for note"""
         self.mtime = self.now()
         self.dirty = True
+        self.change_count += 1
         self.start_change_timeout()
         if self.immediate_change_callback:
             self.immediate_change_callback(self)
 
-    def matches(self, pattern):
-        """Does this note match a search pattern?
-        
-        The search pattern is a list of words, each word being a string.
-        The matching is done ignoring case differences, but with the 
-        assumption that each word has been converted to lower case by
-        the caller (via word.lower()), so that this method only needs to
-        convert the note text itself into lower case for matching.
+    def matches(self, pattern):
+        """Does this note match a search pattern?
+        
+        The search pattern is a list of words, each word being a string.
+        The matching is done ignoring case differences, but with the 
+        assumption that each word has been converted to lower case by
+        the caller (via word.lower()), so that this method only needs to
+        convert the note text itself into lower case for matching.
+        
+        The pattern matches the note if each word in the pattern is
+        included in the note text.
+        
+        """
+        
+        text = self.get_text().lower()
+        for word in pattern:
+            if word.startswith("!") and word != "!":
+                if word[1:] in text:
+                    return False
+            else:
+                if word not in text:
+                    return False
+        return True
+
+    def start_change_timeout(self):
+        """Start a change timeout period
+        
+        The callback will happen self.timeout_length milliseconds after
+        this method is called. If self.timeout_length is not set, then
+        no timeout period will start. That is, you have to call the
+        set_changed_timeout method first.
+        
+        """
+        
+        if self.timeout_length:
+            self.stop_change_timeout()
+            self.timeout_id = gobject.timeout_add(self.timeout_length, 
+                                                  self.buffer_changed_timeout)
+
+    def stop_change_timeout(self):
+        """Stop any current change timeout"""
+        if self.timeout_id:
+            gobject.source_remove(self.timeout_id)
+            self.timeout_id = None
+        
+    def buffer_changed_timeout(self):
+        """Calls the change timeout callback"""
+        if self.timeout_id:
+            self.timeout_callback(self)
+
+    def set_change_timeout(self, milliseconds, callback):
+        """Set the period and callback of a timeout for changes"""
+        self.timeout_length = milliseconds
+        self.timeout_callback = callback
+
+    def set_immediate_change_callback(self, callback):
+        """Set function to be called immediately on any change"""
+        self.immediate_change_callback = callback
+
+    def set_edit_callback(self, callback):
+        """Set function to be called with each edit
+        
+        The callback gets the note, the kind of edit ("insert",
+        "delete", or "set"), and its arguments: character offset and
+        text for "insert", start and end offsets for "delete", and the
+        new text for "set".
+        
+        """
+        self.edit_callback = callback
+
+    def buffer_insert_text(self, buffer, iter, text, length):
+        """Report text inserted into the buffer to the edit callback"""
+        if self.edit_callback:
+            self.edit_callback(self, "insert", iter.get_offset(), text)
+
+    def buffer_delete_range(self, buffer, start, end):
+        """Report text deleted from the buffer to the edit callback"""
+        if self.edit_callback:
+            self.edit_callback(self, "delete", start.get_offset(), 
+                               end.get_offset())
+
+
+class BufferCache:
+
+    """Limit the number of GtkTextBuffers kept for notes
+
+    A GtkTextBuffer takes several times as much memory as the text in
+    it, and users only ever look at a few notes, so it is wasteful to
+    keep a buffer for every note. This class remembers which notes have
+    buffers, in least recently used order, and when there are more
+    than 'size' of them, releases the buffers of the least recently
+    used notes that are not pinned (shown in a window).
+
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.notes = []
+
+    def use(self, note):
+        """Remember that a note's buffer has just been used"""
+        if self.notes and self.notes[-1] is note:
+            return
+        self.forget(note)
+        self.notes.append(note)
+        self.trim()
+
+    def forget(self, note):
+        """Stop keeping track of a note"""
+        if note in self.notes:
+            self.notes.remove(note)
+
+    def trim(self):
+        """Release buffers until there are at most 'size' of them"""
+        excess = len(self.notes) - self.size
+        for note in self.notes[:]:
+            if excess <= 0:
+                break
+            if note.release_buffer():
+                self.notes.remove(note)
+                excess -= 1
+
+
+class SearchIndex:
+
+    """An index of the text in a set of notes
+
+    Matching a search pattern against every note means getting the
+    text of every note out of its GtkTextBuffer and converting it to
+    lower case, for every keystroke in the search field. This class
+    keeps, instead, the lower case text of each note, and two inverted
+    indexes on it. The index is updated one note at a time, whenever
+    the note changes. The words and trigrams of a note are not kept:
+    when it changes or is removed, they are found again from its old
+    text.
+
+    Note.matches treats each pattern word as a substring of the text,
+    not as a whole word, and the index gives exactly the same answers.
+    For pattern words of at least three characters, every trigram in
+    the word must also be in the note, so the intersection of the
+    trigram posting lists gives a small set of candidate notes, which
+    are then verified against their text. Shorter words are looked up
+    in the vocabulary of the notes instead: a word that contains no
+    whitespace is a substring of the text exactly when it is a
+    substring of one of the words (maximal runs of non-whitespace
+    characters) in the text.
+
+    Notes whose text has not been read from disk yet (see
+    Note.load_lazily) are not indexed until a search needs them. An
+    empty pattern matches every note without reading any, and a
+    search done in steps indexes them a few at a time, see index_some.
+
+    """
+
+    TRIGRAM_LENGTH = 3
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """Forget all notes"""
+        self.texts = {}
+        self.postings = {}
+        self.trigram_postings = {}
+        self.cache = {}
+        self.unindexed = set()
+
+    def get_trigrams(self, text):
+        """Return the set of trigrams in a (lower case) text"""
+        n = self.TRIGRAM_LENGTH
+        return set([text[i:i+n] for i in range(len(text) - n + 1)])
+
+    def add_to_postings(self, postings, keys, note):
+        """Add note to the posting lists of each key"""
+        for key in keys:
+            if key in postings:
+                postings[key].add(note)
+            else:
+                postings[key] = set([note])
+
+    def remove_from_postings(self, postings, keys, note):
+        """Remove note from the posting lists of each key"""
+        for key in keys:
+            notes = postings[key]
+            notes.discard(note)
+            if not notes:
+                del postings[key]
+
+    def add_note(self, note):
+        """Add a note to the index, or update it if it is there already"""
+        if note.is_loaded():
+            self.unindexed.discard(note)
+            self.set_text(note, note.get_text())
+        else:
+            self.unindexed.add(note)
+
+    def index_unindexed(self):
+        """Index the notes whose text had not been read yet"""
+        if self.unindexed:
+            logging.debug("Indexing %d notes" % len(self.unindexed))
+            self.index_some(len(self.unindexed))
+
+    def index_some(self, count):
+        """Index at most 'count' of the notes whose text was not read yet
+        
+        A note whose file can no longer be read, because it has been
+        removed since it was catalogued, is dropped from the index.
+        Return True if there are still notes left to index.
+        
+        """
+        while self.unindexed and count > 0:
+            note = self.unindexed.pop()
+            try:
+                text = note.get_text()
+            except IOError, e:
+                logging.debug("Can't read note %s, not indexing it: %s" %
+                              (note.id, str(e)))
+            else:
+                self.set_text(note, text)
+            count -= 1
+        return len(self.unindexed) > 0
+
+    def set_text(self, note, text):
+        """Index 'text' as the text of 'note'
+
+        The note can actually be any hashable object: the index never
+        looks at it, except via add_note.
+
+        """
+
+        text = text.lower()
+        if self.texts.get(note) == text:
+            return
+        words = set(text.split())
+        trigrams = self.get_trigrams(text)
+        if note in self.texts:
+            old_text = self.texts[note]
+            old_words = set(old_text.split())
+            old_trigrams = self.get_trigrams(old_text)
+            self.remove_from_postings(self.postings, old_words - words, note)
+            self.add_to_postings(self.postings, words - old_words, note)
+            self.remove_from_postings(self.trigram_postings,
+                                      old_trigrams - trigrams, note)
+            self.add_to_postings(self.trigram_postings,
+                                 trigrams - old_trigrams, note)
+        else:
+            self.add_to_postings(self.postings, words, note)
+            self.add_to_postings(self.trigram_postings, trigrams, note)
+        self.texts[note] = text
+        self.cache = {}
+
+    def update_note(self, note):
+        """Update the index after a note has changed"""
+        self.add_note(note)
+
+    def remove_note(self, note):
+        """Remove a note from the index"""
+        self.unindexed.discard(note)
+        if note not in self.texts:
+            return
+        text = self.texts.pop(note)
+        self.remove_from_postings(self.postings, set(text.split()), note)
+        self.remove_from_postings(self.trigram_postings,
+                                  self.get_trigrams(text), note)
+        self.cache = {}
+
+    def get_notes(self):
+        """Return set of all notes in the index"""
+        return set(self.texts) | self.unindexed
+
+    def get_candidates(self, word):
+        """Return set of notes that may include 'word'
+
+        The word must be at least TRIGRAM_LENGTH characters long.
+
+        """
+
+        lists = []
+        for trigram in self.get_trigrams(word):
+            if trigram not in self.trigram_postings:
+                return set()
+            lists.append(self.trigram_postings[trigram])
+        lists.sort(lambda a, b: cmp(len(a), len(b)))
+        candidates = set(lists[0])
+        for notes in lists[1:]:
+            if not candidates:
+                break
+            candidates &= notes
+        return candidates
+
+    def find_word(self, word):
+        """Return set of notes whose text includes 'word'"""
+        if word in self.cache:
+            return self.cache[word]
+        if len(word) >= self.TRIGRAM_LENGTH:
+            notes = set([note for note in self.get_candidates(word)
+                         if word in self.texts[note]])
+        elif word.split() == [word]:
+            notes = set()
+            for indexed_word, postings in self.postings.iteritems():
+                if word in indexed_word:
+                    notes.update(postings)
+        else:
+            # Short words with whitespace in them can't be answered
+            # from either index.
+            notes = set([note for note, text in self.texts.iteritems()
+                         if word in text])
+        self.cache[word] = notes
+        return notes
+
+    def matches(self, note, pattern):
+        """Does an indexed note match a pattern?
+
+        This is like Note.matches, but uses the text in the index
+        rather than the note's buffer.
+
+        """
+
+        text = self.texts[note]
+        for word in pattern:
+            if word.startswith("!") and word != "!":
+                if word[1:] in text:
+                    return False
+            elif word not in text:
+                return False
+        return True
+
+    def find(self, pattern, within=None):
+        """Return set of notes that match a search pattern
+
+        See Note.matches for the meaning of the pattern. If 'within' is
+        given, only notes in that set are considered. A small set is
+        tested note by note, a large one is intersected with the result
+        of a full search, whichever is cheaper.
+
+        """
+
+        if not pattern:
+            if within is None:
+                return self.get_notes()
+            return set(within) & self.get_notes()
+        self.index_unindexed()
+        if within is not None:
+            within = set([note for note in within if note in self.texts])
+            if len(within) * 4 < len(self.texts):
+                return set([note for note in within
+                            if self.matches(note, pattern)])
+            return self.find(pattern) & within
+
+        result = self.get_notes()
+        for word in pattern:
+            if not result:
+                break
+            if word.startswith("!") and word != "!":
+                result -= self.find_word(word[1:])
+            else:
+                result &= self.find_word(word)
+        return result
+
+
+def search_worker(connection):
+    """Serve search requests for one ProcessSearchIndex shard
+
+    This runs in a separate process. It keeps a SearchIndex of plain
+    strings, keyed by note id, and reads requests from 'connection'
+    until told to quit.
+
+    """
+
+    index = SearchIndex()
+    while True:
+        request = connection.recv()
+        if request[0] == "set":
+            index.set_text(request[1], request[2])
+        elif request[0] == "remove":
+            index.remove_note(request[1])
+        elif request[0] == "clear":
+            index.clear()
+        elif request[0] == "find":
+            connection.send(list(index.find(request[1], request[2])))
+        elif request[0] == "quit":
+            break
+    connection.close()
+
+
+class ProcessSearchIndex:
+
+    """A SearchIndex split across several worker processes
+
+    Matching is pure computation, and in CPython it can only use one
+    processor core at a time. This class has the same interface as
+    SearchIndex, but shards the notes across a number of worker
+    processes, by note id. Each worker keeps a SearchIndex of the plain
+    text of its own notes, which is updated whenever a note changes.
+    A search is sent to all workers at once, and their answers are
+    combined into one set. As in SearchIndex, notes whose text has not
+    been read yet are only sent to the workers when a search needs
+    them, see index_some.
+
+    This requires the multiprocessing module (Python 2.6 or later); if
+    it is missing, 'available' is false.
+
+    """
+
+    available = multiprocessing is not None
+
+    def __init__(self, processes):
+        self.connections = []
+        self.processes = []
+        for i in range(processes):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=search_worker,
+                                              args=(child,))
+            process.daemon = True
+            process.start()
+            child.close()
+            self.connections.append(parent)
+            self.processes.append(process)
+        self.notes = {}
+        self.unindexed = set()
+
+    def close(self):
+        """Stop the worker processes"""
+        for connection in self.connections:
+            connection.send(("quit",))
+            connection.close()
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []
+
+    def get_connection(self, id):
+        """Return connection to worker responsible for note id"""
+        return self.connections[hash(id) % len(self.connections)]
+
+    def clear(self):
+        """Forget all notes"""
+        for connection in self.connections:
+            connection.send(("clear",))
+        self.notes = {}
+        self.unindexed = set()
+
+    def add_note(self, note):
+        """Add a note to the index, or update it if it is there already"""
+        self.notes[note.id] = note
+        if note.is_loaded():
+            self.unindexed.discard(note)
+            self.get_connection(note.id).send(("set", note.id, 
+                                               note.get_text()))
+        else:
+            self.unindexed.add(note)
+
+    def update_note(self, note):
+        """Update the index after a note has changed"""
+        self.add_note(note)
+
+    def index_some(self, count):
+        """Send at most 'count' unread notes to the workers
+        
+        This is the same as SearchIndex.index_some: a note whose file
+        can no longer be read is dropped from the index. Return True
+        if there are still notes left to index.
+        
+        """
+        while self.unindexed and count > 0:
+            note = self.unindexed.pop()
+            try:
+                text = note.get_text()
+            except IOError, e:
+                logging.debug("Can't read note %s, not indexing it: %s" %
+                              (note.id, str(e)))
+                if self.notes.get(note.id) is note:
+                    del self.notes[note.id]
+            else:
+                self.get_connection(note.id).send(("set", note.id, text))
+            count -= 1
+        return len(self.unindexed) > 0
+
+    def remove_note(self, note):
+        """Remove a note from the index"""
+        self.unindexed.discard(note)
+        if self.notes.get(note.id) is note:
+            del self.notes[note.id]
+            self.get_connection(note.id).send(("remove", note.id))
+
+    def get_notes(self):
+        """Return set of all notes in the index"""
+        return set(self.notes.itervalues())
+
+    def find(self, pattern, within=None):
+        """Return set of notes that match a search pattern
+
+        This is the same as SearchIndex.find, but the work is done by
+        the worker processes in parallel.
+
+        """
+
+        if not pattern:
+            if within is None:
+                return self.get_notes()
+            return set(within) & self.get_notes()
+        self.index_some(len(self.unindexed))
+        if within is None:
+            requests = [(connection, None) for connection in self.connections]
+        else:
+            shards = {}
+            for note in within:
+                if self.notes.get(note.id) is note:
+                    connection = self.get_connection(note.id)
+                    shards.setdefault(connection, []).append(note.id)
+            requests = shards.items()
+        for connection, ids in requests:
+            connection.send(("find", pattern, ids))
+        result = set()
+        for connection, ids in requests:
+            for id in connection.recv():
+                result.add(self.notes[id])
+        return result
+
+
+class SearchState:
+
+    """The latest search done in one window
+
+    Users type their search pattern one character at a time, so that
+    each new pattern is usually a refinement of the previous one
+    ("pro", "proj", "proje"), and can only match a subset of the notes
+    the previous one matched. Similarly, deleting characters from the
+    search field broadens the pattern, so that everything that matched
+    before still matches.
+
+    This class remembers the previous pattern and its result set, and
+    which notes have been changed or added since, so that a new search
+    only needs to re-test the notes whose visibility may change.
+
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forget the previous search"""
+        self.pattern = None
+        self.visible = set()
+        self.changed = set()
+
+    def word_implies(self, word, other):
+        """Does a note matching pattern word 'word' also match 'other'?"""
+        negative = word.startswith("!") and word != "!"
+        other_negative = other.startswith("!") and other != "!"
+        if negative != other_negative:
+            return False
+        if negative:
+            return word[1:] in other[1:]
+        return other in word
+
+    def narrows(self, pattern, previous):
+        """Does every note matching 'pattern' also match 'previous'?"""
+        for other in previous:
+            for word in pattern:
+                if self.word_implies(word, other):
+                    break
+            else:
+                return False
+        return True
+
+    def search(self, index, pattern):
+        """Return set of notes matching pattern, and remember it"""
+        if self.pattern is None:
+            visible = index.find(pattern)
+        elif self.narrows(pattern, self.pattern):
+            visible = index.find(pattern, self.visible | self.changed)
+        elif self.narrows(self.pattern, pattern):
+            unchanged = self.visible - self.changed
+            hidden = index.get_notes() - unchanged
+            visible = unchanged | index.find(pattern, hidden)
+        else:
+            visible = index.find(pattern)
+        self.pattern = pattern
+        self.visible = visible
+        self.changed = set()
+        return visible
+
+    def note_changed(self, note):
+        """Remember that a note needs to be re-tested"""
+        self.changed.add(note)
+
+    def forget_note(self, note):
+        """Forget a note that has been removed"""
+        self.visible.discard(note)
+        self.changed.discard(note)
+
+
+class Catalog:
+
+    """Meta data about all notes in a note directory
+
+    Reading every note file at startup is slow, especially with a cold
+    disk cache or a home directory on NFS. The catalog is a file in the
+    note directory that remembers, for each note file, its stat
+    signature (modification time, size, and inode number), the digest
+    of its contents, and the title of the note. A note whose file
+    still has the same signature does not need to be read at startup.
+
+    The catalog is only ever a cache: if it is missing, or cannot be
+    parsed, all notes are read and a new catalog is written. A new
+    catalog is written to a temporary file first and then renamed, so
+    that a crash cannot leave a half-written catalog behind.
+
+    """
+
+    FILENAME = ".notetak-catalog"
+    MAGIC = "notetak-catalog 1"
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.filename = os.path.join(dirname, self.FILENAME)
+
+    def is_catalog_file(self, basename):
+        """Is a file in the note directory part of the catalog?"""
+        return basename.startswith(self.FILENAME)
+
+    def get_signature(self, st):
+        """Return the signature of a file, from the result of os.stat"""
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def read(self):
+        """Read the catalog
+        
+        Return a dictionary from the basename of a note file to a tuple
+        (signature, digest, title). If the catalog cannot be read, an
+        empty dictionary is returned.
+        
+        """
+
+        entries = {}
+        try:
+            f = file(self.filename, "r")
+            try:
+                if f.readline() != self.MAGIC + "\n":
+                    raise ValueError("bad catalog header")
+                for line in f:
+                    if not line.endswith("\n"):
+                        raise ValueError("truncated catalog")
+                    (basename, mtime, size, inode, digest, 
+                     title) = line[:-1].split("\t", 5)
+                    signature = (float(mtime), int(size), int(inode))
+                    entries[basename] = (signature, digest, title)
+            finally:
+                f.close()
+        except (IOError, ValueError), e:
+            logging.debug("Ignoring catalog %s: %s" % (self.filename, e))
+            return {}
+        return entries
+
+    def write(self, entries):
+        """Write the catalog, replacing the old one
+        
+        'entries' is a dictionary like the one returned by read.
+        
+        """
+
+        logging.debug("Writing catalog %s" % self.filename)
+        lines = [self.MAGIC + "\n"]
+        for basename, (signature, digest, title) in entries.iteritems():
+            mtime, size, inode = signature
+            lines.append("%s\t%r\t%d\t%d\t%s\t%s\n" % 
+                         (basename, mtime, size, inode, digest, title))
+        write_file(self.filename, "".join(lines))
+
+
+class Journal:
+
+    """An append-only log of edits to the notes in a note directory
+
+    Notes are only saved some time after the user stops typing, and
+    anything typed since the last save is lost if the program crashes.
+    To avoid that, every edit is also appended to the journal, which is
+    cheap compared to writing the whole note. When the note directory
+    is next loaded, the journal is replayed on top of the note files.
+    Once all notes have been saved, the journal is no longer needed,
+    and is removed.
+
+    Each edit is one line in the journal: the kind of edit, the note
+    id, the digest of the text the edit is relative to (see
+    Note.journal_base), and the arguments of the edit. A note's edits
+    are only replayed if they are relative to the text the note has
+    at that point of the replay. Edits relative to a text that has been
+    saved since, and whose results are thus already in the note file,
+    are skipped.
+
+    """
+
+    FILENAME = ".notetak-journal"
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.filename = os.path.join(dirname, self.FILENAME)
+        self.file = None
+
+    def record(self, note, kind, *args):
+        """Append an edit to the journal"""
+        fields = [kind, note.id, note.journal_base]
+        for arg in args:
+            if type(arg) == str:
+                fields.append(arg.encode("string_escape"))
+            else:
+                fields.append(str(arg))
+        if self.file is None:
+            self.file = file(self.filename, "a")
+        self.file.write("\t".join(fields) + "\n")
+        self.file.flush()
+
+    def read(self):
+        """Return list of edits in the journal
+        
+        Each edit is a tuple (kind, id, base, args). Reading stops at
+        the first line that cannot be parsed, such as an incomplete
+        last line after a crash.
+        
+        """
+
+        edits = []
+        try:
+            f = file(self.filename, "r")
+        except IOError:
+            return edits
+        try:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                fields = line[:-1].split("\t")
+                if len(fields) < 3:
+                    break
+                kind, id, base = fields[:3]
+                try:
+                    if kind == "insert" and len(fields) == 5:
+                        args = (int(fields[3]), 
+                                fields[4].decode("string_escape"))
+                    elif kind == "delete" and len(fields) == 5:
+                        args = (int(fields[3]), int(fields[4]))
+                    elif kind == "set" and len(fields) == 4:
+                        args = (fields[3].decode("string_escape"),)
+                    elif kind == "remove" and len(fields) == 3:
+                        args = ()
+                    else:
+                        break
+                except ValueError:
+                    break
+                edits.append((kind, id, base, args))
+        finally:
+            f.close()
+        return edits
+
+    def replay(self, notes):
+        """Replay the journal on top of the texts of notes
+        
+        'notes' is a dictionary from note id to Note, as loaded from
+        disk. Return a dictionary from note id to new text, for those
+        notes whose text was changed by the journal, including notes
+        that are not in 'notes' at all. A note that was removed has None
+        as its new text. Only notes that are in the journal are read.
+        
+        """
+
+        current = {}
+        bases = {}
+        applying = {}
+        for kind, id, base, args in self.read():
+            if id not in current:
+                if id in notes:
+                    current[id] = notes[id].get_text()
+                else:
+                    current[id] = ""
+            text = current[id]
+            if bases.get(id) != base:
+                bases[id] = base
+                applying[id] = (text is not None and 
+                                md5(text).hexdigest() == base)
+            if not applying[id]:
+                continue
+            if kind == "insert":
+                offset, inserted = args
+                chars = text.decode("utf-8")
+                current[id] = (chars[:offset].encode("utf-8") + inserted + 
+                               chars[offset:].encode("utf-8"))
+            elif kind == "delete":
+                start, end = args
+                chars = text.decode("utf-8")
+                current[id] = (chars[:start] + chars[end:]).encode("utf-8")
+            elif kind == "set":
+                current[id] = args[0]
+            elif kind == "remove":
+                current[id] = None
+
+        changes = {}
+        for id, text in current.iteritems():
+            if id in notes:
+                if text != notes[id].get_text():
+                    changes[id] = text
+            elif text:
+                changes[id] = text
+        return changes
+
+    def close(self):
+        """Close the journal file, if it is open"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def clear(self):
+        """Forget all edits, because they have all been saved"""
+        self.close()
+        if os.path.exists(self.filename):
+            logging.debug("Removing journal %s" % self.filename)
+            os.remove(self.filename)
+
+
+class DirectoryStorage:
+
+    """Store notes in a directory, one file per note
+
+    This is the default storage. Each note is stored in a file named
+    after its id, with the modification time of the file being that of
+    the note. A Catalog and a Journal are kept in the same directory.
+
+    The files can be written in the background by a NoteWriter: the
+    storage then only needs to be told of files written and removed,
+    to keep the catalog up to date.
+
+    Very large directories are slow to list and to look up files in,
+    for us and for backup tools alike. A directory can therefore be
+    converted, with shard, to a fan-out layout, where the file of a note
+    is in two levels of subdirectories named after the end of its id,
+    for example ef/cd/abcdef.note, see note_path. The layout is
+    recorded in a file in the directory. Names of note files, such as
+    the keys of the catalog entries, are relative to the directory.
+
+    """
+
+    background = True
+    available = True
+    BATCH_SIZE = 200
+    LAYOUT_FILENAME = ".notetak-layout"
+    FANOUT = "fanout"
+
+    def __init__(self, dirname):
+        self.name = dirname
+        self.dirname = dirname
+        self.catalog = Catalog(dirname)
+        self.catalog_entries = {}
+        self.unsynced_dirs = set()
+        self.layout_filename = os.path.join(dirname, self.LAYOUT_FILENAME)
+        self.sharded = self.read_layout() == self.FANOUT
+
+    def read_layout(self):
+        """Return the name of the layout of the directory, or None"""
+        try:
+            f = file(self.layout_filename, "r")
+            layout = f.read().strip()
+            f.close()
+        except IOError:
+            return None
+        return layout
+
+    def note_path(self, id):
+        """Return the name of the file for a note id, relative to us
+        
+        In the fan-out layout, the subdirectories are named after the
+        last four characters of the id, last two first. The start of a
+        time-ordered id (see notetakuuid.uuid7) is a timestamp, and
+        would put all notes made within weeks of each other in the same
+        subdirectory; its end is random and spreads them evenly. Ids
+        too short to name both levels of subdirectories stay in the top
+        directory.
+        
+        """
+        if self.sharded and len(id) >= 4:
+            return os.path.join(id[-2:], id[-4:-2], id + ".note")
+        return id + ".note"
+
+    def note_filename(self, note):
+        """Return the filename for a note, including the path"""
+        return os.path.join(self.dirname, self.note_path(note.id))
+
+    def relative_name(self, filename):
+        """Return the name of a file in the directory, relative to us"""
+        return filename[len(os.path.join(self.dirname, "")):]
+
+    def is_note_file(self, basename):
+        """Is a file in the directory a note, as opposed to our own?"""
+        return not (self.catalog.is_catalog_file(basename) or
+                    basename == Journal.FILENAME or
+                    basename == self.LAYOUT_FILENAME or
+                    is_temp_filename(basename))
+
+    def is_shard(self, basename):
+        """Is an entry in the top directory a subdirectory of notes?"""
+        return (self.sharded and len(basename) == 2 and
+                os.path.isdir(os.path.join(self.dirname, basename)))
+
+    def list_shard(self, shard):
+        """Return names of the note files in a subdirectory, sorted"""
+        names = []
+        for sub in sorted(os.listdir(os.path.join(self.dirname, shard))):
+            subdir = os.path.join(self.dirname, shard, sub)
+            if not os.path.isdir(subdir):
+                continue
+            for basename in sorted(os.listdir(subdir)):
+                if self.is_note_file(basename):
+                    names.append(os.path.join(shard, sub, basename))
+        return names
+
+    def list_note_files(self, threads=1):
+        """Return names of all files in the directory that may be notes
+        
+        In the fan-out layout, the subdirectories are listed by a pool
+        of 'threads' threads. A note file in the top directory of a
+        sharded directory, left there by an interrupted shard, is
+        included as well.
+        
+        """
+        names = []
+        shards = []
+        for basename in sorted(os.listdir(self.dirname)):
+            if self.is_shard(basename):
+                shards.append(basename)
+            elif self.is_note_file(basename):
+                names.append(basename)
+        def add_batch(lists):
+            for shard_names in lists:
+                names.extend(shard_names)
+        map_in_threads(self.list_shard, shards, threads, self.BATCH_SIZE,
+                       add_batch)
+        return names
+
+    def shard(self):
+        """Convert the directory to the fan-out layout, in place
+        
+        The layout file is written first, and then the note files are
+        renamed into their subdirectories one by one. Each rename is
+        atomic, so if this is interrupted, every note is in one place
+        or the other, and calling this again, or loading the directory,
+        finishes the job. Return the number of notes moved. See
+        note_path for how the subdirectory of a note is chosen.
+        
+        """
+        logging.debug("Sharding %s" % self.dirname)
+        if not self.sharded:
+            write_file(self.layout_filename, self.FANOUT + "\n")
+            sync_directory(self.dirname)
+            self.sharded = True
+        entries = self.catalog.read()
+        subdirs = set()
+        count = 0
+        for basename in os.listdir(self.dirname):
+            filename = os.path.join(self.dirname, basename)
+            if (not self.is_note_file(basename) or 
+                not os.path.isfile(filename)):
+                continue
+            name = self.note_path(id_from_filename(filename))
+            if name == basename:
+                continue
+            subdir = os.path.dirname(os.path.join(self.dirname, name))
+            make_parent_directory(os.path.join(self.dirname, name))
+            os.rename(filename, os.path.join(self.dirname, name))
+            subdirs.add(subdir)
+            if basename in entries:
+                entries[name] = entries.pop(basename)
+            count += 1
+        for subdir in subdirs:
+            sync_directory(subdir)
+        sync_directory(self.dirname)
+        if count:
+            self.catalog.write(entries)
+        return count
+
+    def create(self):
+        """Create the directory, if it does not exist yet"""
+        if not os.path.exists(self.dirname):
+            logging.debug("Creating %s" % self.dirname)
+            os.mkdir(self.dirname)
+
+    def load(self, threads=1, callback=None, read_only=False):
+        """Return list of all notes in the directory
+        
+        Notes whose files have not changed since the catalog was
+        written are not actually read: their text is read only when it
+        is needed. The other files are read by a pool of 'threads'
+        threads, see map_in_threads. If given, callback is called with
+        each batch of notes as they are ready, in the order of the
+        files in the directory. Unless 'read_only' is true, an
+        interrupted shard is finished and the catalog is updated.
+        
+        """
+
+        if self.sharded and not read_only:
+            self.shard()
+        old_entries = self.catalog.read()
+        entries = {}
+        notes = []
+        names = self.list_note_files(threads)
+
+        def read(name):
+            return self.read_file(name, old_entries.get(name))
+
+        def add_batch(results):
+            batch = []
+            for name, st, text in results:
+                if st is None:
+                    continue
+                fullname = os.path.join(self.dirname, name)
+                note = Note(id_from_filename(name))
+                if text is None:
+                    digest, title = old_entries[name][1:]
+                    note.load_lazily(fullname, title, st.st_size, 
+                                     st.st_mtime, digest)
+                else:
+                    note.load_data(note.id, text, st.st_mtime)
+                    note.filename = fullname
+                entries[name] = (self.catalog.get_signature(st), 
+                                 note.digest, note.title)
+                batch.append(note)
+            notes.extend(batch)
+            if callback:
+                callback(batch)
+
+        map_in_threads(read, names, threads, self.BATCH_SIZE, add_batch)
+        self.catalog_entries = entries
+        if entries != old_entries and not read_only:
+            self.catalog.write(entries)
+        return notes
+
+    def read_file(self, name, entry):
+        """Return (name, stat, text) for a file in the directory
+        
+        The text is None if the catalog entry of the file shows that it
+        does not need to be read yet, and the stat is None if the file
+        is not a regular file or has gone missing. This is called from
+        the threads of the loader, and must not touch anything shared.
+        
+        """
+        fullname = os.path.join(self.dirname, name)
+        try:
+            st = os.stat(fullname)
+        except OSError:
+            return name, None, None
+        if not stat.S_ISREG(st.st_mode):
+            return name, None, None
+        if entry and entry[0] == self.catalog.get_signature(st):
+            return name, st, None
+        f = file(fullname, "r")
+        text = f.read()
+        f.close()
+        return name, st, text
+
+    def iter_notes(self):
+        """Yield (id, mtime, text) for each note, reading one at a time"""
+        for name in self.list_note_files():
+            name, st, text = self.read_file(name, None)
+            if st is not None:
+                yield id_from_filename(name), st.st_mtime, text
+
+    def save_note(self, note):
+        """Write a note to its file"""
+        filename = self.note_filename(note)
+        make_parent_directory(filename)
+        note.save(filename)
+        self.unsynced_dirs.add(os.path.dirname(filename))
+        self.note_written(filename, note, os.stat(filename))
+
+    def note_written(self, filename, note, st):
+        """Remember the catalog entry of a note file just written"""
+        signature = self.catalog.get_signature(st)
+        self.catalog_entries[self.relative_name(filename)] = \
+            (signature, note.digest, note.get_title())
+
+    def remove_note(self, note):
+        """Remove the file of a note"""
+        filename = self.note_filename(note)
+        note.remove(filename)
+        self.unsynced_dirs.add(os.path.dirname(filename))
+        self.forget_note(note)
+
+    def forget_note(self, note):
+        """Forget the catalog entry of a note whose file is removed"""
+        self.catalog_entries.pop(self.note_path(note.id), None)
+
+    def write_catalog(self):
+        """Write the catalog with the files written so far"""
+        self.catalog.write(self.catalog_entries)
+
+    def commit(self):
+        """Make the notes written and removed so far durable
+        
+        Every directory a note was written to or removed from is
+        synced, which in the fan-out layout means the subdirectories.
+        
+        """
+        self.write_catalog()
+        for dirname in self.unsynced_dirs:
+            sync_directory(dirname)
+        self.unsynced_dirs = set()
+        sync_directory(self.dirname)
+
+    def get_journal(self):
+        """Return the Journal for the notes"""
+        return Journal(self.dirname)
+
+    def get_search_index(self):
+        """Return the search index to use, or None for the default"""
+        return None
+
+    def close(self):
+        """Stop using the storage"""
+
+
+class SqliteStorage:
+
+    """Store notes in a single SQLite database file
+
+    Some file systems deal badly with lots of small files, and one
+    database file is also easier to move around. The database has a
+    table of note ids, modification times, and texts.
+
+    If SQLite is new enough to have the trigram tokenizer for FTS5,
+    there is also a full text index of the notes, which can answer
+    substring queries in the style of Note.matches, without having to
+    read every note. The trigram index only narrows down the notes
+    that may match, each of them is then checked with instr(), which
+    also handles words too short for the index and "!word".
+
+    Writes go into a transaction that commit ends, so a batch of saves
+    costs one commit. The storage keeps no journal: an autosave is
+    cheap enough.
+
+    """
+
+    SUFFIX = ".sqlite"
+    background = False
+    available = sqlite3 is not None
+
+    def __init__(self, filename):
+        self.name = filename
+        self.connection = None
+        self.fts = False
+
+    def connect(self):
+        """Return the database connection, opening it if needed"""
+        if self.connection is None:
+            logging.debug("Opening SQLite database %s" % self.name)
+            self.connection = sqlite3.connect(self.name)
+            self.connection.text_factory = str
+            self.connection.execute("CREATE TABLE IF NOT EXISTS notes "
+                                    "(id TEXT PRIMARY KEY, mtime REAL, "
+                                    "text TEXT)")
+            try:
+                self.connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS "
+                                        "notes_fts USING fts5(id UNINDEXED, "
+                                        "text, tokenize='trigram')")
+                self.fts = True
+            except sqlite3.OperationalError, e:
+                logging.debug("Not using full text search: %s" % e)
+            self.connection.commit()
+        return self.connection
+
+    def create(self):
+        """Create the database, if it does not exist yet"""
+        self.connect()
+
+    def load(self, threads=1, callback=None, read_only=False):
+        """Return list of all notes in the database
+        
+        The notes are read in the caller's thread; 'threads' and
+        'read_only' are only there for compatibility with
+        DirectoryStorage.load.
+        
+        """
+        notes = []
+        for id, mtime, text in self.connect().execute(
+                "SELECT id, mtime, text FROM notes"):
+            note = Note(id)
+            note.load_data(id, text, mtime)
+            notes.append(note)
+        if callback and notes:
+            callback(notes)
+        return notes
+
+    def iter_notes(self):
+        """Yield (id, mtime, text) for each note, reading one at a time"""
+        for row in self.connect().execute("SELECT id, mtime, text FROM notes"):
+            yield row
+
+    def save_note(self, note):
+        """Write a note to the database"""
+        text = note.get_text()
+        connection = self.connect()
+        connection.execute("INSERT OR REPLACE INTO notes (id, mtime, text) "
+                           "VALUES (?, ?, ?)", (note.id, note.mtime, text))
+        if self.fts:
+            connection.execute("DELETE FROM notes_fts WHERE id = ?", 
+                               (note.id,))
+            connection.execute("INSERT INTO notes_fts (id, text) "
+                               "VALUES (?, ?)", (note.id, text))
+        note.digest = md5(text).hexdigest()
+        note.journal_base = note.digest
+        note.dirty = False
+
+    def remove_note(self, note):
+        """Remove a note from the database"""
+        connection = self.connect()
+        connection.execute("DELETE FROM notes WHERE id = ?", (note.id,))
+        if self.fts:
+            connection.execute("DELETE FROM notes_fts WHERE id = ?", 
+                               (note.id,))
+
+    def commit(self):
+        """Commit the notes written and removed so far"""
+        self.connect().commit()
+
+    def find(self, pattern):
+        """Return list of ids of notes that match a pattern
+        
+        See Note.matches for the meaning of the pattern. Notes are
+        matched as they are in the database.
+        
+        """
+
+        conditions = []
+        params = []
+        for word in pattern:
+            if word.startswith("!") and word != "!":
+                conditions.append("instr(lower(text), ?) = 0")
+                params.append(word[1:])
+            else:
+                if self.fts and len(word) >= SearchIndex.TRIGRAM_LENGTH:
+                    conditions.append("id IN (SELECT id FROM notes_fts "
+                                      "WHERE notes_fts MATCH ?)")
+                    params.append('"%s"' % word.replace('"', '""'))
+                conditions.append("instr(lower(text), ?) > 0")
+                params.append(word)
+        sql = "SELECT id FROM notes"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        return [row[0] for row in self.connect().execute(sql, params)]
+
+    def get_journal(self):
+        """Return the Journal for the notes, or None"""
+        return None
+
+    def get_search_index(self):
+        """Return the search index to use, or None for the default"""
+        self.connect()
+        if self.fts:
+            return SqliteSearchIndex(self)
+        return None
+
+    def close(self):
+        """Close the database"""
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def open_storage(name):
+    """Return the storage for a note directory or database
+    
+    Names ending in SqliteStorage.SUFFIX, and existing files, are
+    SQLite databases, anything else is a directory.
+    
+    """
+    if name.endswith(SqliteStorage.SUFFIX) or os.path.isfile(name):
+        return SqliteStorage(name)
+    return DirectoryStorage(name)
+
+
+class SqliteSearchIndex:
+
+    """A search index that uses the full text index of a SqliteStorage
+
+    The database only knows the notes as they were last saved, so notes
+    that have changed since they were added to the index are matched
+    with Note.matches instead.
+
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.clear()
+
+    def clear(self):
+        """Forget all notes"""
+        self.notes = {}
+        self.changed = set()
+
+    def add_note(self, note):
+        """Add a note to the index, or update it if it is there already"""
+        self.notes[note.id] = note
+        if note.dirty:
+            self.changed.add(note)
+
+    def update_note(self, note):
+        """Update the index after a note has changed"""
+        self.notes[note.id] = note
+        self.changed.add(note)
+
+    def index_some(self, count):
+        """Nothing to do: the database has the text of all notes"""
+        return False
+
+    def remove_note(self, note):
+        """Remove a note from the index"""
+        if self.notes.get(note.id) is note:
+            del self.notes[note.id]
+        self.changed.discard(note)
+
+    def get_notes(self):
+        """Return set of all notes in the index"""
+        return set(self.notes.values())
+
+    def find(self, pattern, within=None):
+        """Return set of notes that match a search pattern"""
+        result = set()
+        for id in self.storage.find(pattern):
+            note = self.notes.get(id)
+            if note is not None and note not in self.changed:
+                result.add(note)
+        for note in self.changed:
+            if note.matches(pattern):
+                result.add(note)
+        if within is not None:
+            result &= within
+        return result
+
+
+class NoteWriter:
+
+    """Write note files in a background thread
+
+    Writing a file can take a long time, especially on a network file
+    system, and the GTK main loop should not wait for it. This class
+    takes snapshots of the text to be written, and a background thread
+    writes them. If a file is saved again before the previous snapshot
+    has been written, only the newer one gets written. Files can also
+    be removed via the writer, so that a removal cannot be overtaken by
+    a write that was queued before it.
+
+    Files are written with write_file. Whenever the queue becomes
+    empty, the directories of the files written since the last time
+    are synced, so a burst of saves costs only one directory sync.
+
+    When a file has been written and synced, the callback given to the
+    initializer is called in the main thread, via gobject.idle_add, with the
+    filename, the opaque 'data' given to save, the digest of the text
+    written, and the result of os.stat on the new file. If the writing
+    fails, the error is logged and the callback is not called.
+
+    """
+
+    def __init__(self, callback):
+        gobject.threads_init()
+        self.callback = callback
+        self.condition = threading.Condition()
+        self.queue = []
+        self.pending = {}
+        self.writing = False
+        self.done = []
+        self.unsynced = []
+        self.unsynced_dirs = set()
+        self.idle_id = None
+        self.quitting = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def add_job(self, filename, job):
+        """Queue a job for a file, replacing any pending job for it"""
+        self.condition.acquire()
+        try:
+            if filename not in self.pending:
+                self.queue.append(filename)
+            self.pending[filename] = job
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def save(self, filename, text, mtime, data):
+        """Queue a file to be written, and its mtime set"""
+        self.add_job(filename, (text, mtime, data))
+
+    def remove(self, filename):
+        """Queue a file to be removed"""
+        self.add_job(filename, None)
+
+    def is_idle(self):
+        """Has everything queued been written?"""
+        self.condition.acquire()
+        try:
+            return not self.queue and not self.writing
+        finally:
+            self.condition.release()
+
+    def run(self):
+        """Write queued files until close is called"""
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.queue and not self.quitting:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                filename = self.queue.pop(0)
+                job = self.pending.pop(filename)
+                self.writing = True
+            finally:
+                self.condition.release()
+
+            try:
+                if job is None:
+                    if os.path.exists(filename):
+                        os.remove(filename)
+                else:
+                    self.unsynced.append(self.write(filename, job))
+                self.unsynced_dirs.add(os.path.dirname(filename))
+            except (IOError, OSError), e:
+                logging.warning("Could not write %s: %s" % (filename, e))
+
+            self.condition.acquire()
+            try:
+                last = not self.queue
+            finally:
+                self.condition.release()
+            if last:
+                for dirname in self.unsynced_dirs:
+                    sync_directory(dirname)
+                self.unsynced_dirs = set()
+
+            self.condition.acquire()
+            try:
+                self.writing = False
+                if last and self.unsynced:
+                    self.done += self.unsynced
+                    self.unsynced = []
+                    if self.idle_id is None:
+                        self.idle_id = gobject.idle_add(self.report)
+                self.condition.notifyAll()
+            finally:
+                self.condition.release()
+
+    def write(self, filename, job):
+        """Write one file, and return the arguments for the callback"""
+        text, mtime, data = job
+        make_parent_directory(filename)
+        write_file(filename, text, mtime)
+        return filename, data, md5(text).hexdigest(), os.stat(filename)
+
+    def report(self):
+        """Call the callback for files that have been written"""
+        self.condition.acquire()
+        try:
+            done = self.done
+            self.done = []
+            self.idle_id = None
+        finally:
+            self.condition.release()
+        for result in done:
+            apply(self.callback, result)
+        return False
+
+    def drain(self, timeout):
+        """Wait, at most 'timeout' seconds, until the queue is empty
         
-        The pattern matches the note if each word in the pattern is
-        included in the note text.
+        The callbacks for the files written so far are called before
+        returning. Return True if everything was written.
         
         """
-        
-        start, end = self.buffer.get_bounds()
-        text = self.buffer.get_text(start, end)
-        text = text.lower()
-        for word in pattern:
-            if word.startswith("!") and word != "!":
-                if word[1:] in text:
-                    return False
+        deadline = time.time() + timeout
+        self.condition.acquire()
+        try:
+            while self.queue or self.writing:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            finished = not self.queue and not self.writing
+        finally:
+            self.condition.release()
+        self.report()
+        if not finished:
+            logging.warning("Gave up waiting for notes to be written")
+        return finished
+
+    def close(self):
+        """Stop the thread once the queue is empty"""
+        self.condition.acquire()
+        try:
+            self.quitting = True
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+
+_libc = None
+
+
+def get_inotify():
+    """Return the C library, if it provides inotify, or None
+    
+    The library is looked up only once, among the libraries already
+    loaded into the process: ctypes.util.find_library would run
+    ldconfig or even gcc at every startup.
+    
+    """
+    global _libc
+    if _libc is None:
+        _libc = False
+        if ctypes is not None and sys.platform.startswith("linux"):
+            try:
+                libc = ctypes.CDLL(None)
+                libc.inotify_init
+                libc.inotify_add_watch
+            except (OSError, AttributeError):
+                logging.debug("inotify is not available")
             else:
-                if word not in text:
-                    return False
+                _libc = libc
+    return _libc or None
+
+
+class InotifyWatcher:
+
+    """Watch a directory for changed files, using Linux inotify
+    
+    The callback is called from the main loop with the set of names of
+    files in the directory that were created, replaced, written or
+    removed, or with None if the kernel lost track and all files need
+    to be looked at.
+    
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+    HEADER = "iIII"
+
+    def __init__(self, dirname, callback):
+        self.dirname = dirname
+        self.callback = callback
+        libc = get_inotify()
+        if libc is None:
+            raise OSError("inotify is not available")
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError("inotify_init failed")
+        wd = libc.inotify_add_watch(self.fd, dirname, self.MASK)
+        if wd < 0:
+            os.close(self.fd)
+            raise OSError("inotify_add_watch failed for %s" % dirname)
+        self.source = gobject.io_add_watch(self.fd, gobject.IO_IN, 
+                                           self.read_events)
+
+    def read_events(self, fd, condition):
+        """Read queued events and report the files they are about"""
+        data = os.read(self.fd, 65536)
+        header_size = struct.calcsize(self.HEADER)
+        basenames = set()
+        pos = 0
+        while pos + header_size <= len(data):
+            wd, mask, cookie, length = \
+                struct.unpack(self.HEADER, data[pos:pos + header_size])
+            pos += header_size
+            name = data[pos:pos + length].rstrip("\0")
+            pos += length
+            if mask & self.IN_Q_OVERFLOW:
+                basenames = None
+                break
+            if name:
+                basenames.add(name)
+        if basenames is None or basenames:
+            self.callback(basenames)
         return True
 
-    def start_change_timeout(self):
-        """Start a change timeout period
+    def close(self):
+        """Stop watching"""
+        gobject.source_remove(self.source)
+        os.close(self.fd)
+
+
+class PollingWatcher:
+
+    """Watch a directory for changed files by looking at it regularly
+    
+    This is used where inotify is not available. The callback is
+    called like that of InotifyWatcher.
+    
+    Statting every file every few seconds would stall the user
+    interface with a large directory. Every INTERVAL milliseconds, only
+    the directory itself is looked at: the files are statted again
+    only if it has changed, as it does when files are created, removed
+    or renamed over, or else every FULL_SCAN_EVERY intervals, to catch
+    files changed in place. The files are statted FILES_PER_STEP at a
+    time in an idle callback, like searches in a Window.
+    
+    """
+
+    INTERVAL = 2000
+    FULL_SCAN_EVERY = 15
+    FILES_PER_STEP = 200
+
+    def __init__(self, dirname, callback):
+        self.dirname = dirname
+        self.callback = callback
+        self.signatures = {}
+        self.ticks = 0
+        self.steps = None
+        self.idle_id = None
+        self.dir_signature = self.get_dir_signature()
+        self.start_scan(False)
+        self.source = gobject.timeout_add(self.INTERVAL, self.poll)
+
+    def get_dir_signature(self):
+        """Return the stat signature of the directory, or None
         
-        The callback will happen self.timeout_length milliseconds after
-        this method is called. If self.timeout_length is not set, then
-        no timeout period will start. That is, you have to call the
-        set_changed_timeout method first.
+        None is also returned if the directory changed less than a
+        second ago, since another change within the same second might
+        not change its modification time.
         
         """
-        
-        if self.timeout_length:
-            self.stop_change_timeout()
-            self.timeout_id = gobject.timeout_add(self.timeout_length, 
-                                                  self.buffer_changed_timeout)
+        try:
+            st = os.stat(self.dirname)
+        except OSError:
+            return None
+        if st.st_mtime >= time.time() - 1:
+            return None
+        return (st.st_mtime, st.st_ino)
 
-    def stop_change_timeout(self):
-        """Stop any current change timeout"""
-        if self.timeout_id:
-            gobject.source_remove(self.timeout_id)
-            self.timeout_id = None
+    def scan_in_steps(self, report):
+        """Stat the files in the directory, FILES_PER_STEP at a time
         
-    def buffer_changed_timeout(self):
-        """Calls the change timeout callback"""
-        if self.timeout_id:
-            self.timeout_callback(self)
-
-    def set_change_timeout(self, milliseconds, callback):
-        """Set the period and callback of a timeout for changes"""
-        self.timeout_length = milliseconds
-        self.timeout_callback = callback
+        This is a generator that yields after each step. At the end,
+        the changed files are given to the callback if 'report' is
+        true.
+        
+        """
+        signatures = {}
+        done = 0
+        for basename in os.listdir(self.dirname):
+            try:
+                st = os.stat(os.path.join(self.dirname, basename))
+            except OSError:
+                continue
+            signatures[basename] = (st.st_mtime, st.st_size, st.st_ino)
+            done += 1
+            if done % self.FILES_PER_STEP == 0:
+                yield done
+        basenames = set(signatures.keys() + self.signatures.keys())
+        changed = set([basename for basename in basenames
+                       if signatures.get(basename) != 
+                          self.signatures.get(basename)])
+        self.signatures = signatures
+        if changed and report:
+            self.callback(changed)
+
+    def start_scan(self, report):
+        """Start statting the files in an idle callback"""
+        self.steps = self.scan_in_steps(report)
+        self.idle_id = gobject.idle_add(self.continue_scan)
+
+    def continue_scan(self):
+        """Do one step of the scan; return False when it is finished"""
+        try:
+            self.steps.next()
+        except (StopIteration, OSError):
+            self.steps = None
+            self.idle_id = None
+            return False
+        return True
 
-    def set_immediate_change_callback(self, callback):
-        """Set function to be called immediately on any change"""
-        self.immediate_change_callback = callback
+    def finish_scan(self):
+        """Do the rest of the scan that is going on, if any, at once"""
+        if self.idle_id is not None:
+            gobject.source_remove(self.idle_id)
+            while self.continue_scan():
+                pass
 
+    def poll(self):
+        """Start a scan, if the directory has changed or it is time"""
+        if self.steps is not None:
+            return True
+        self.ticks += 1
+        dir_signature = self.get_dir_signature()
+        if (dir_signature is not None and 
+            dir_signature == self.dir_signature and
+            self.ticks % self.FULL_SCAN_EVERY != 0):
+            return True
+        self.dir_signature = dir_signature
+        self.start_scan(True)
+        return True
 
-class TooManyVisibilityColumns(Exception):
+    def close(self):
+        """Stop watching"""
+        gobject.source_remove(self.source)
+        if self.idle_id is not None:
+            gobject.source_remove(self.idle_id)
+            self.idle_id = None
 
-    """Exception for when there are too many windows for one NoteList"""
 
-    def __str__(self):
-        return "Too many windows"
+def watch_directory(dirname, callback):
+    """Start watching a directory, with inotify if possible"""
+    try:
+        return InotifyWatcher(dirname, callback)
+    except OSError, e:
+        logging.debug("Polling %s for changes: %s" % (dirname, str(e)))
+        return PollingWatcher(dirname, callback)
 
 
 class NoteList:
@@ -264,22 +2294,56 @@ class NoteList:
     
     This class represents all notes in a note directory. Like with
     Notes, the decision of what the directory is called is left to
-    external code.
+    external code. The notes are actually stored by a storage object,
+    see open_storage: usually a DirectoryStorage, but the "directory"
+    can also be a SqliteStorage database.
     
     Because of how the GtkTreeView family of objects is implemented,
     this class also keeps track of which notes are visible in which
     application window. A GtkTreeView widget acts as the View in a
     Model/View/Controller setup, and this class acts as a Model. The
     View can show only some of the items in the Model, and this is
-    controlled by a data column in the Model. To support multiple
-    views into the same model, there can be many such visibility
-    columns. However, all columns are created at startup, then the
-    model is created. This requires deciding on a limit on the number
-    of views (alas).
+    decided by a visibility function on a GtkTreeModelFilter. To
+    support multiple views into the same model, there can be any
+    number of visibility columns. A visibility column is not a column
+    in the GtkListStore, but a compact array with one byte per row:
+    each row has a slot number, stored in the model, which indexes
+    the arrays of all visibility columns.
+
+    To find the row for a note without looking through the whole
+    model, the GtkTreeIter of each row is kept in a dictionary, by note
+    id. Iterators of a GtkListStore stay valid for as long as the row
+    exists, even when the rows get sorted, and unlike
+    GtkTreeRowReferences they cost nothing to keep up to date when
+    rows are inserted, removed, or re-ordered.
+
+    Searching is done via a SearchIndex, which is kept up to date as
+    notes are added, changed, and removed. Each visibility column also
+    has a SearchState, which remembers the latest search for it.
+
+    Edits that have not been saved yet are kept in the Journal of the
+    storage, if it has one.
+
+    The notes that have changed since the last save are kept in a set,
+    as are notes that have been removed from the list while there was
+    no directory to remove them from, so that save_dirty only needs to
+    touch the files that actually need it.
+
+    If a NoteWriter is set with set_writer, save_dirty only queues the
+    changed notes to be written in the background. A note stays dirty
+    until its file has been written, and if it changed again meanwhile,
+    until that change has been written, too.
     
     """
 
-    MAX_VISIBILITY_COLUMNS = 128
+    ROWS_PER_STEP = 200
+    BUFFER_CACHE_SIZE = 32
+    LOAD_THREADS = 8
+    FLUSH_TIMEOUT = 10.0
+
+    # This is GTK_TREE_SORTABLE_UNSORTED_SORT_COLUMN_ID, which PyGTK
+    # does not export.
+    UNSORTED_SORT_COLUMN_ID = -2
 
     def __init__(self, change_timeout_time=None, change_timeout_callback=None):
         logging.debug("Creating new NoteList")
@@ -287,7 +2351,7 @@ class NoteList:
         self.change_timeout_time = change_timeout_time
         self.change_timeout_callback = change_timeout_callback
         
-        column_types = [gobject.TYPE_BOOLEAN] * self.MAX_VISIBILITY_COLUMNS
+        column_types = []
 
         self.NOTE_COLUMN = len(column_types)
         column_types += [gobject.TYPE_PYOBJECT]
@@ -295,16 +2359,73 @@ class NoteList:
         self.TITLE_COLUMN = len(column_types)
         column_types += [gobject.TYPE_STRING]
 
+        self.SLOT_COLUMN = len(column_types)
+        column_types += [gobject.TYPE_INT]
+
         self.liststore = apply(gtk.ListStore, column_types)
         self.liststore.set_sort_column_id(self.TITLE_COLUMN, 
                                           gtk.SORT_ASCENDING)
+        self.rows = {}
+        self.slot_count = 0
+        self.free_slots = []
         self.visibility_columns = []
-        self.available_visibility_columns = range(self.MAX_VISIBILITY_COLUMNS)
+        self.visibility_bits = {}
+        self.shown_notes = {}
+        self.next_visibility_column = 0
+        self.index = SearchIndex()
+        self.buffer_cache = BufferCache(self.BUFFER_CACHE_SIZE)
+        self.search_states = {}
+        self.generation = 0
+        self.storage = None
+        self.dirty_notes = set()
+        self.removed_notes = set()
+        self.writer = None
+        self.journal = None
+        self.load_threads = self.LOAD_THREADS
         self.dirty = False
 
+    def set_load_threads(self, threads):
+        """Set the number of threads reading note files when loading"""
+        self.load_threads = max(1, threads)
+
+    def set_writer(self, writer):
+        """Write notes in the background with a NoteWriter"""
+        self.writer = writer
+
+    def set_search_index(self, index):
+        """Use a different search index, such as a ProcessSearchIndex"""
+        self.index.clear()
+        self.index = index
+        for note in self.get_notes():
+            index.add_note(note)
+        for state in self.search_states.itervalues():
+            state.reset()
+
     def note_filename(self, dirname, note):
         """Return the filename for a note, including the path"""
-        return os.path.join(dirname, note.id + ".note")
+        return DirectoryStorage(dirname).note_filename(note)
+
+    def is_current_storage(self, dirname):
+        """Is 'dirname' the storage in use, perhaps under another name?"""
+        return (self.storage is not None and
+                os.path.realpath(self.storage.name) ==
+                os.path.realpath(dirname))
+
+    def get_storage(self, dirname):
+        """Return the storage for a note directory"""
+        if self.is_current_storage(dirname):
+            return self.storage
+        return open_storage(dirname)
+
+    def set_storage(self, storage):
+        """Use 'storage' from now on, and its journal"""
+        if self.storage is not storage:
+            if self.storage:
+                self.storage.close()
+            self.storage = storage
+        if self.journal:
+            self.journal.close()
+        self.journal = storage.get_journal()
 
     def get_notes(self):
         """Return all notes as a Python list"""
@@ -315,13 +2436,22 @@ class NoteList:
             iter = self.liststore.iter_next(iter)
         return notes
 
+    def find_iters_for_note(self, note):
+        """Return list of GtkTreeIters for the rows showing a note"""
+        return [iter for iter in self.rows.get(note.id, [])
+                if self.liststore.get_value(iter, self.NOTE_COLUMN) is note]
+
+    def find_note(self, id):
+        """Return the note with a given id, or None"""
+        for iter in self.rows.get(id, []):
+            return self.liststore.get_value(iter, self.NOTE_COLUMN)
+        return None
+
     def find_iter_for_note(self, note):
         """Find the GtkIter corresponding to a note"""
-        iter = self.liststore.get_iter_first()
-        while iter:
-            if self.liststore.get_value(iter, self.NOTE_COLUMN) == note:
-                return iter
-            iter = self.liststore.iter_next(iter)
+        iters = self.find_iters_for_note(note)
+        if iters:
+            return iters[0]
         return None
 
     def get_from_title_column(self, note):
@@ -335,136 +2465,695 @@ class NoteList:
     def append_note(self, note):
         """Add a new note to the end of the list"""
         logging.debug("Adding note %s to NoteList" % note.id)
-        iter = self.liststore.append()
-        for i in range(self.MAX_VISIBILITY_COLUMNS):
-            self.liststore.set_value(iter, i, False)
-        self.liststore.set_value(iter, self.NOTE_COLUMN, note)
-        self.update_title_column(note)
-        note.set_immediate_change_callback(self.update_title_column)
+        self.add_row(note)
+        self.generation += 1
+        self.dirty = True
+
+    def add_rows(self, notes):
+        """Add rows for a batch of notes, without sorting the list"""
+        for note in notes:
+            self.add_row(note)
+
+    def add_row(self, note):
+        """Add a row for a note, and start tracking changes to it"""
+        iter = self.liststore.append([note, note.get_title(), 
+                                      self.allocate_slot()])
+        self.rows.setdefault(note.id, []).append(iter)
+        self.index.add_note(note)
+        for state in self.search_states.itervalues():
+            state.note_changed(note)
+        note.set_immediate_change_callback(self.note_changed)
         note.set_change_timeout(self.change_timeout_time,
                                 self.change_timeout_callback)
-        self.dirty = True
+        note.set_buffer_cache(self.buffer_cache)
+        note.set_edit_callback(self.note_edited)
+        if note.dirty:
+            self.dirty_notes.add(note)
+            self.note_edited(note, "set", note.get_text())
+        self.removed_notes.discard(note)
+
+    def allocate_slot(self):
+        """Return an unused slot number for a new row"""
+        if self.free_slots:
+            return self.free_slots.pop()
+        slot = self.slot_count
+        self.slot_count += 1
+        for bits in self.visibility_bits.itervalues():
+            bits.append(0)
+        return slot
+
+    def free_slot(self, slot):
+        """Mark a slot number as unused"""
+        for bits in self.visibility_bits.itervalues():
+            bits[slot] = 0
+        self.free_slots.append(slot)
+
+    def note_changed(self, note):
+        """Update title column and search index after a note changes"""
+        if note.dirty:
+            self.dirty_notes.add(note)
+        self.update_title_column(note)
+        self.index.update_note(note)
+        for state in self.search_states.itervalues():
+            state.note_changed(note)
 
     def update_title_column(self, note):
         """Update title column for note"""
-        iter = self.find_iter_for_note(note)
-        if iter:
-            self.liststore.set_value(iter, self.TITLE_COLUMN, 
-                                     note.get_title())
+        title = note.get_title()
+        for iter in self.find_iters_for_note(note):
+            if self.liststore.get_value(iter, self.TITLE_COLUMN) != title:
+                self.liststore.set_value(iter, self.TITLE_COLUMN, title)
 
     def remove_note(self, dirname, note):
         """Remove a note from the list"""
         logging.debug("Removing note %s from NoteList" % note.id)
-        iter = self.liststore.get_iter_first()
-        while iter:
-            if self.liststore.get_value(iter, self.NOTE_COLUMN) == note:
-                self.liststore.remove(iter)
-                if dirname is not None:
-                    note.remove(self.note_filename(dirname, note))
-                self.dirty = True
-                return
-            iter = self.liststore.iter_next(iter)
-        logging.debug("Oops, note %s not in NoteList, can't remove" % note.id)
+        if not self.remove_row(note):
+            return
+        if dirname is None and self.find_iter_for_note(note) is None:
+            self.removed_notes.add(note)
+        if dirname is not None:
+            self.remove_note_file(dirname, note)
+        self.dirty = True
+
+    def remove_row(self, note):
+        """Remove a row showing a note, without touching storage
+        
+        When the last row goes, the note is forgotten. Return False if
+        the note was not in the list.
+        
+        """
+        iter = self.find_iter_for_note(note)
+        if iter is None:
+            logging.debug("Oops, note %s not in NoteList, can't remove" % 
+                          note.id)
+            return False
+        iters = self.rows[note.id]
+        del iters[iters.index(iter)]
+        if not iters:
+            del self.rows[note.id]
+        slot = self.liststore.get_value(iter, self.SLOT_COLUMN)
+        self.liststore.remove(iter)
+        self.free_slot(slot)
+        self.generation += 1
+        if self.find_iter_for_note(note) is None:
+            self.index.remove_note(note)
+            self.buffer_cache.forget(note)
+            for state in self.search_states.itervalues():
+                state.forget_note(note)
+            for shown in self.shown_notes.itervalues():
+                shown.discard(note)
+            self.dirty_notes.discard(note)
+            self.note_edited(note, "remove")
+        return True
+
+    def remove_note_file(self, dirname, note):
+        """Remove a note from storage"""
+        storage = self.get_storage(dirname)
+        if self.writer and storage.background:
+            self.writer.remove(storage.note_filename(note))
+            storage.forget_note(note)
+        else:
+            storage.remove_note(note)
+            storage.commit()
 
     def clear(self):
         """Remove all notes from the list"""
         logging.debug("Forgetting (not removing on disk) all notes in list")
         self.liststore.clear()
-
-    def load(self, dirname):
-        """Load all notes into memory"""
+        self.buffer_cache.notes = []
+        self.dirty_notes = set()
+        self.removed_notes = set()
+        if self.journal:
+            self.journal.close()
+        self.journal = None
+        if self.storage:
+            self.storage.close()
+        self.storage = None
+        self.rows = {}
+        self.slot_count = 0
+        self.free_slots = []
+        for bits in self.visibility_bits.itervalues():
+            del bits[:]
+        for shown in self.shown_notes.itervalues():
+            shown.clear()
+        self.generation += 1
+        self.index.clear()
+        for state in self.search_states.itervalues():
+            state.reset()
+
+    def load(self, dirname, read_only=False):
+        """Load all notes into memory
+        
+        The note files are read by a pool of threads, and the notes are
+        added to the list in batches as they are read, with sorting
+        turned off until all have been added. Edits in the journal that
+        had not been saved are then replayed. With 'read_only', nothing
+        is written to the directory while loading it.
+        Loading the note directory that is already in use only picks up
+        the changes made to it outside the program, see files_changed.
+        
+        """
+        if (self.is_current_storage(dirname) and
+            isinstance(self.storage, DirectoryStorage)):
+            logging.debug("Rereading changed notes in %s" % dirname)
+            self.files_changed(None)
+            return
         logging.debug("Loading notes from %s" % dirname)
-        for basename in os.listdir(dirname):
-            fullname = os.path.join(dirname, basename)
-            if os.path.isfile(fullname):
-                note = Note()
-                note.load(fullname)
-                self.append_note(note)
+        storage = open_storage(dirname)
+        index = storage.get_search_index()
+        if index is not None and isinstance(self.index, SearchIndex):
+            self.set_search_index(index)
+        elif index is None and isinstance(self.index, SqliteSearchIndex):
+            self.set_search_index(SearchIndex())
+        self.liststore.set_sort_column_id(self.UNSORTED_SORT_COLUMN_ID,
+                                          gtk.SORT_ASCENDING)
+        try:
+            storage.load(self.load_threads, self.add_rows, read_only)
+        finally:
+            self.liststore.set_sort_column_id(self.TITLE_COLUMN, 
+                                              gtk.SORT_ASCENDING)
+        self.generation += 1
         self.make_clean()
+        self.replay_journal(storage)
         logging.debug("Done loading notes from %s" % dirname)
 
+    def replay_journal(self, storage):
+        """Apply edits from the journal that had not been saved
+        
+        The notes that the journal changes are marked dirty, so that
+        they get saved. Notes that the journal removes only leave the
+        list: their files are removed by the next save. After this,
+        'storage' is used from now on, and new edits are added to its
+        journal.
+        
+        """
+        if self.journal:
+            self.journal.close()
+        self.journal = None
+        journal = storage.get_journal()
+        if journal is not None:
+            notes = {}
+            for note in self.get_notes():
+                notes[note.id] = note
+            changes = journal.replay(notes)
+            for id, text in changes.iteritems():
+                logging.debug("Replaying journal for note %s" % id)
+                note = notes.get(id)
+                if text is None:
+                    if note is not None:
+                        self.remove_note(None, note)
+                elif note is None:
+                    note = Note(id)
+                    note.set_text(text)
+                    self.append_note(note)
+                else:
+                    note.set_text(text)
+            journal.close()
+        self.set_storage(storage)
+
+    def files_changed(self, names):
+        """Pick up changes made to note files outside the program
+        
+        'names' is a set of names of files in the note directory, see
+        DirectoryStorage, that may have changed, or None to look at all
+        of them. This is the callback of the directory watchers.
+        
+        """
+        storage = self.storage
+        if not isinstance(storage, DirectoryStorage):
+            return
+        if names is None:
+            names = set(storage.list_note_files(self.load_threads))
+            names.update(storage.catalog_entries.keys())
+        changed = False
+        for name in names:
+            basename = os.path.basename(name)
+            if basename.endswith(".note") and storage.is_note_file(basename):
+                changed = self.file_changed(storage, name) or changed
+        if changed:
+            storage.write_catalog()
+
+    def file_changed(self, storage, name):
+        """Update the list from one note file; return True if it changed
+        
+        Files written by ourselves are recognised by their digest, and
+        only update the catalog. A note changed on disk that has also
+        been changed in memory is kept as it is, and the version on disk
+        is added as a new note, so that neither is lost.
+        
+        """
+        filename = os.path.join(storage.dirname, name)
+        id = os.path.basename(name)[:-len(".note")]
+        note = self.find_note(id)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            if note is None or name not in storage.catalog_entries:
+                return False
+            storage.forget_note(note)
+            if note.dirty:
+                logging.warning("Note %s was removed on disk, but has "
+                                "unsaved changes: keeping it" % id)
+            else:
+                logging.debug("Note %s was removed on disk" % id)
+                self.remove_row(note)
+            return True
+        if not stat.S_ISREG(st.st_mode):
+            return False
+        entry = storage.catalog_entries.get(name)
+        if entry and entry[0] == storage.catalog.get_signature(st):
+            return False
+        try:
+            f = file(filename, "r")
+            text = f.read()
+            f.close()
+        except IOError:
+            return False
+        digest = md5(text).hexdigest()
+        if note is None:
+            logging.debug("Note %s was created on disk" % id)
+            note = Note(id)
+            note.load_data(id, text, st.st_mtime)
+            self.append_note(note)
+        elif digest in (note.digest, note.journal_base):
+            note.digest = digest
+        elif note.dirty:
+            logging.warning("Note %s was changed both on disk and in "
+                            "memory: adding the version on disk as a new "
+                            "note" % id)
+            copy = Note()
+            copy.set_text(text)
+            self.append_note(copy)
+        else:
+            logging.debug("Note %s was changed on disk" % id)
+            note.replace_text(text, st.st_mtime)
+        title = text.split("\n", 1)[0]
+        storage.catalog_entries[name] = \
+            (storage.catalog.get_signature(st), digest, title)
+        return True
+
+    def note_edited(self, note, kind, *args):
+        """Add an edit of a note to the journal"""
+        if self.journal:
+            apply(self.journal.record, (note, kind) + args)
+
+    def compact_journal(self, storage):
+        """Remove the journal, if all edits in it have been saved"""
+        if (self.journal and storage is self.storage and 
+            not self.dirty_notes and 
+            (self.writer is None or self.writer.is_idle())):
+            self.journal.clear()
+
+    def queue_note(self, storage, note):
+        """Queue a snapshot of a note to be written by the NoteWriter
+        
+        Later edits to the note are journaled relative to the snapshot.
+        
+        """
+        text = note.get_text()
+        note.journal_base = md5(text).hexdigest()
+        self.writer.save(storage.note_filename(note), text, note.mtime, 
+                         (storage, note, note.change_count))
+
+    def note_written(self, filename, data, digest, st):
+        """Update the state of a note written by the NoteWriter"""
+        storage, note, change_count = data
+        note.digest = digest
+        storage.note_written(filename, note, st)
+        if note.change_count == change_count:
+            note.dirty = False
+            self.dirty_notes.discard(note)
+        if self.writer.is_idle():
+            storage.write_catalog()
+            self.compact_journal(storage)
+
+    def flush(self, timeout):
+        """Wait at most 'timeout' seconds for background writes to finish
+        
+        Return True if everything has been written.
+        
+        """
+        if self.writer is None:
+            return True
+        return self.writer.drain(timeout)
+
     def save(self, dirname):
         """Save all notes to disk"""
         logging.debug("Saving notes to %s" % dirname)
-        if not os.path.exists(dirname):
-            logging.debug("Creating %s" % dirname)
-            os.mkdir(dirname)
+        storage = self.get_storage(dirname)
+        storage.create()
+        self.set_storage(storage)
+        # Queued writes must not overwrite what we write now.
+        self.flush(self.FLUSH_TIMEOUT)
         for note in self.get_notes():
-            note.save(self.note_filename(dirname, note))
+            storage.save_note(note)
+        for note in self.removed_notes:
+            storage.remove_note(note)
+        storage.commit()
         self.make_clean()
+        self.compact_journal(storage)
         logging.debug("Done saving notes to %s" % dirname)
 
     def save_dirty(self, dirname):
-        """Save only changed notes to disk"""
-        logging.debug("Saving dirty notes to %s" % dirname)
-        if not os.path.exists(dirname):
-            logging.debug("Creating %s" % dirname)
-            os.mkdir(dirname)
-        for note in self.get_notes():
-            if note.dirty:
-                note.save(self.note_filename(dirname, note))
+        """Save only changed notes to disk
+        
+        Notes that were removed from the list while there was no
+        directory are removed from disk now.
+        
+        """
+        logging.debug("Saving %d dirty notes to %s" % 
+                      (len(self.dirty_notes), dirname))
+        storage = self.get_storage(dirname)
+        storage.create()
+        saved = self.dirty_notes or self.removed_notes
+        if self.writer and storage.background:
+            for note in self.removed_notes:
+                self.writer.remove(storage.note_filename(note))
+                storage.forget_note(note)
+            self.removed_notes = set()
+            for note in self.dirty_notes:
+                self.queue_note(storage, note)
+            self.dirty = False
+            logging.debug("Queued dirty notes to be saved to %s" % dirname)
+            return
+        for note in self.removed_notes:
+            storage.remove_note(note)
+        for note in self.dirty_notes:
+            storage.save_note(note)
+        if saved:
+            storage.commit()
         self.make_clean()
+        self.compact_journal(storage)
         logging.debug("Done saving dirty notes to %s" % dirname)
 
     def find_matching(self, pattern):
         """Return all notes matching a pattern"""
-        return [note for note in self.get_notes() if note.matches(pattern)]
+        matches = self.index.find(pattern)
+        return [note for note in self.get_notes() if note in matches]
 
     def get_visibility_columns(self):
         """Return list of numbers of visibility columns currently in use"""
         return self.visibility_columns
 
     def add_visibility_column(self):
-        """Allocate a visibility column
-        
-        This will raise the TooManyVisibilityColumns exception if there
-        are no un-allocated visibility columns.
-        
-        """
-        if not self.available_visibility_columns:
-            raise TooManyVisibilityColumns()
-        col = self.available_visibility_columns[0]
-        del self.available_visibility_columns[0]
+        """Allocate a visibility column, and return its number"""
+        col = self.next_visibility_column
+        self.next_visibility_column += 1
         self.visibility_columns.append(col)
+        self.visibility_bits[col] = array.array("B", [0]) * self.slot_count
+        self.shown_notes[col] = set()
+        self.search_states[col] = SearchState()
         return col
 
     def remove_visibility_column(self, col):
         """Free up a visibility column"""
         self.visibility_columns.remove(col)
-        self.available_visibility_columns.append(col)
+        del self.visibility_bits[col]
+        del self.shown_notes[col]
+        del self.search_states[col]
+
+    def row_is_visible(self, model, iter, col):
+        """Is a row visible according to column 'col'?
+        
+        This is meant to be used as the visibility function of a
+        GtkTreeModelFilter, with the column number as its user data.
+        
+        """
+        bits = self.visibility_bits.get(col)
+        slot = model.get_value(iter, self.SLOT_COLUMN)
+        return bits is not None and 0 <= slot < len(bits) and bits[slot] == 1
+
+    def get_visible_count(self, col):
+        """Return number of notes visible according to column 'col'"""
+        return len(self.shown_notes[col])
 
     def get_visible_notes(self, col):
         """Return list of notes visibile according to column 'col'"""
         notes = []
         iter = self.liststore.get_iter_first()
         while iter:
-            if self.liststore.get_value(iter, col):
+            if self.row_is_visible(self.liststore, iter, col):
                 notes.append(self.liststore.get_value(iter, self.NOTE_COLUMN))
             iter = self.liststore.iter_next(iter)
         return notes
 
     def mark_visible_rows(self, col, pattern):
         """Mark in column 'col' as visible all notes matching 'pattern'"""
-        iter = self.liststore.get_iter_first()
-        while iter:
-            note = self.liststore.get_value(iter, self.NOTE_COLUMN)
-            self.liststore.set_value(iter, col, note.matches(pattern))
-            iter = self.liststore.iter_next(iter)
+        for count in self.mark_visible_rows_in_steps(col, pattern):
+            pass
+
+    def mark_visible_rows_in_steps(self, col, pattern):
+        """Mark visible rows like mark_visible_rows, a few at a time
+
+        This is a generator. It does the work in steps of
+        ROWS_PER_STEP notes, and yields the number of notes visible so
+        far after each step, so that the caller can do other things in
+        between. If notes are added or removed between steps, the search
+        is updated before continuing.
+
+        Only rows whose visibility actually changes are modified, so
+        that the GtkTreeModelFilters and GtkTreeViews only need to deal
+        with those. The notes currently visible are kept in a set, which
+        also gives the number of visible notes without counting them.
+
+        Notes whose text has not been read yet are indexed first, also
+        ROWS_PER_STEP at a time, unless the pattern is empty and they
+        are not needed.
+
+        """
+
+        state = self.search_states[col]
+        bits = self.visibility_bits[col]
+        shown = self.shown_notes[col]
+        if pattern:
+            while self.index.index_some(self.ROWS_PER_STEP):
+                yield len(shown)
+        matches = state.search(self.index, pattern)
+        flips = list(matches ^ shown)
+        generation = self.generation
+        done = 0
+        while flips:
+            note = flips.pop()
+            visible = int(note in matches)
+            for iter in self.find_iters_for_note(note):
+                slot = self.liststore.get_value(iter, self.SLOT_COLUMN)
+                if bits[slot] != visible:
+                    bits[slot] = visible
+                    self.liststore.row_changed(self.liststore.get_path(iter),
+                                               iter)
+            if visible:
+                shown.add(note)
+            else:
+                shown.discard(note)
+            done += 1
+            if done % self.ROWS_PER_STEP == 0:
+                yield len(shown)
+                if self.generation != generation:
+                    matches = state.search(self.index, pattern)
+                    flips = list(matches ^ shown)
+                    generation = self.generation
 
     def is_dirty(self):
         """Has the list or any of its notes been modified?"""
-        if self.dirty:
-            return True
-        for note in self.get_notes():
-            if note.dirty:
-                return True
-        return False
+        return self.dirty or len(self.dirty_notes) > 0
 
     def make_clean(self):
         """Mark list of notes and all notes therein as unmodified"""
         self.dirty = False
-        for note in self.get_notes():
+        for note in self.dirty_notes:
             note.dirty = False
+        self.dirty_notes = set()
+        self.removed_notes = set()
+
+
+def migrate(source, target):
+    """Copy all notes from one note directory or database to another
+    
+    This converts between storage formats, see open_storage. Edits
+    that are still only in the journal of the source are included.
+    The source is only read. Return the number of notes copied.
+    
+    """
+    notelist = NoteList()
+    notelist.load(source, read_only=True)
+    notelist.save(target)
+    count = len(notelist.get_notes())
+    notelist.clear()
+    return count
+
+
+class TarArchive:
+
+    """A tar file of notes, one "<id>.note" member per note
+    
+    The archive is read and written as a stream, so only one note is
+    in memory at a time. Tar only keeps whole seconds of the
+    modification times.
+    
+    """
+
+    SUFFIXES = [".tar", ".tar.gz", ".tgz", ".tar.bz2"]
+    available = True
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def read(self):
+        """Yield (id, mtime, text) for each note in the archive"""
+        tar = tarfile.open(self.filename, "r|*")
+        for info in tar:
+            if info.isfile() and info.name.endswith(".note"):
+                id = check_note_id(info.name[:-len(".note")])
+                f = tar.extractfile(info)
+                text = f.read()
+                f.close()
+                yield id, float(info.mtime), text
+        tar.close()
+
+    def write(self, notes):
+        """Write the notes from an iterable of (id, mtime, text)
+        
+        As with write_file, the notes go to a temporary file that is
+        renamed over the archive only once all of them are written.
+        
+        """
+        mode = "w|"
+        if self.filename.endswith("gz"):
+            mode = "w|gz"
+        elif self.filename.endswith(".bz2"):
+            mode = "w|bz2"
+        temp = temp_filename(self.filename)
+        try:
+            tar = tarfile.open(temp, mode)
+            try:
+                for id, mtime, text in notes:
+                    info = tarfile.TarInfo(id + ".note")
+                    info.size = len(text)
+                    info.mtime = int(mtime)
+                    info.mode = 0644
+                    tar.addfile(info, StringIO.StringIO(text))
+            finally:
+                tar.close()
+            os.rename(temp, self.filename)
+        except:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+
+class JsonLinesArchive:
+
+    """A file of notes, one JSON object per line
+    
+    Each line has the id, mtime and text of a note. The text should be
+    UTF-8, as GTK makes it; a note that is not is written as Latin-1,
+    with an "encoding" field so that it is read back unchanged.
+    
+    """
+
+    SUFFIXES = [".jsonl"]
+    available = json is not None
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def read(self):
+        """Yield (id, mtime, text) for each note in the archive"""
+        f = file(self.filename, "r")
+        for line in f:
+            if line.strip():
+                obj = json.loads(line)
+                encoding = obj.get("encoding", "utf-8")
+                yield (check_note_id(str(obj["id"])), float(obj["mtime"]), 
+                       obj["text"].encode(encoding))
+        f.close()
+
+    def write(self, notes):
+        """Write the notes from an iterable of (id, mtime, text)
+        
+        As with write_file, the notes go to a temporary file that is
+        renamed over the archive only once all of them are written.
+        
+        """
+        temp = temp_filename(self.filename)
+        try:
+            f = file(temp, "w")
+            try:
+                for id, mtime, text in notes:
+                    obj = {"id": id, "mtime": mtime}
+                    try:
+                        obj["text"] = text.decode("utf-8")
+                    except UnicodeDecodeError:
+                        logging.warning("Note %s is not UTF-8, writing it "
+                                        "as Latin-1" % id)
+                        obj["text"] = text.decode("latin-1")
+                        obj["encoding"] = "latin-1"
+                    f.write(json.dumps(obj) + "\n")
+            finally:
+                f.close()
+            os.rename(temp, self.filename)
+        except:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+
+def open_archive(name):
+    """Return the archive for a filename, or None if it is not one"""
+    for cls in [TarArchive, JsonLinesArchive]:
+        for suffix in cls.SUFFIXES:
+            if name.endswith(suffix):
+                return cls(name)
+    return None
+
+
+def read_notes(name):
+    """Yield (id, mtime, text) for each note in a storage or archive"""
+    archive = open_archive(name)
+    if archive:
+        return archive.read()
+    return open_storage(name).iter_notes()
+
+
+def write_notes(name, notes):
+    """Write notes from an iterable of (id, mtime, text), one at a time
+    
+    The notes go into an archive, or are added to a note directory or
+    database, replacing any notes there with the same ids.
+    
+    """
+    archive = open_archive(name)
+    if archive:
+        archive.write(notes)
+        return
+    storage = open_storage(name)
+    storage.create()
+    if isinstance(storage, DirectoryStorage):
+        storage.catalog_entries = storage.catalog.read()
+    for id, mtime, text in notes:
+        note = Note(id)
+        note.load_data(id, text, mtime)
+        storage.save_note(note)
+    storage.commit()
+    storage.close()
+
+
+def stream_notes(source, target):
+    """Copy notes between storages and archives, one note at a time
+    
+    Unlike migrate, this never has more than one note in memory, and
+    does not include edits that are only in a journal. Return the
+    number of notes and the total size of their texts.
+    
+    """
+    totals = [0, 0]
+    def count(notes):
+        for id, mtime, text in notes:
+            totals[0] += 1
+            totals[1] += len(text)
+            yield id, mtime, text
+    write_notes(target, count(read_notes(source)))
+    return totals[0], totals[1]
 
 
 class GConfWrapper:
@@ -524,6 +3213,7 @@ class App:
     
     
     AUTOSAVE_DELAY = 1000
+    QUIT_TIMEOUT = 10.0
     
 
     def __init__(self, log_level=None, gconfdir=None):
@@ -533,12 +3223,29 @@ class App:
         logging.debug("Created App object")
         self.notelist = NoteList(self.AUTOSAVE_DELAY, 
                                  lambda *arsg: self.autosave_notelist())
+        self.notelist.set_writer(NoteWriter(self.notelist.note_written))
         self.dirname = None
+        self.watcher = None
         self.windows = []
+        self.glade_buffer = None
         self.gc = GConfWrapper(gconfdir or GCONFDIR)
 
+        # Very large note directories can be searched in parallel by
+        # several processes, if the user has asked for that.
+        processes = self.gc.get_int("search-processes")
+        if processes > 1 and ProcessSearchIndex.available:
+            logging.debug("Using %d search processes" % processes)
+            self.notelist.set_search_index(ProcessSearchIndex(processes))
+
+        # Note directories on network file systems load faster with
+        # more files being read at once.
+        threads = self.gc.get_int("load-threads")
+        if threads > 0:
+            self.notelist.set_load_threads(threads)
+
     def new_notelist(self):
         """Create a new, empty note list"""
+        self.unwatch_notelist()
         self.notelist.clear()
 
     def open_notelist(self, dirname):
@@ -546,12 +3253,33 @@ class App:
         
         This loads all notes in the directory, and remembers the name of
         the directory for future operations. This method corresponds to
-        the File/Open menu entry.
+        the File/Open menu entry. Opening the directory that is already
+        open rereads only the notes changed outside the program.
         
         """
         logging.debug("App.open_notelist: %s" % dirname)
         self.notelist.load(dirname)
         self.dirname = dirname
+        self.watch_notelist()
+
+    def watch_notelist(self):
+        """Start watching the note directory for changes made elsewhere
+        
+        A directory in the fan-out layout has too many subdirectories
+        to watch; opening it again picks up the changes instead.
+        
+        """
+        self.unwatch_notelist()
+        storage = self.notelist.storage
+        if isinstance(storage, DirectoryStorage) and not storage.sharded:
+            self.watcher = watch_directory(storage.dirname,
+                                           self.notelist.files_changed)
+
+    def unwatch_notelist(self):
+        """Stop watching the note directory"""
+        if self.watcher:
+            self.watcher.close()
+        self.watcher = None
 
     def autosave_notelist(self):
         """Automatically save all notes if directory name has been set"""
@@ -559,18 +3287,18 @@ class App:
             self.save_notelist()
 
     def save_notelist(self):
-        """Save all notes
+        """Save all changed notes
         
         This requires that the directory name has been set. Other than
         not invoking "File/Save as..." automatically, this method corresponds
-        to the "File/Save" menu entry.
+        to the "File/Save" menu entry. Only notes that have changed since
+        the last save are written.
         
         """
         logging.debug("App.save_notelist")
         if not self.dirname:
             raise DirnameNotSet()
-        self.notelist.save(self.dirname)
-        self.notelist.make_clean()
+        self.notelist.save_dirty(self.dirname)
 
     def save_notelist_as(self, dirname):
         """Set new name for directory and save all notes
@@ -583,6 +3311,22 @@ class App:
         logging.debug("App.save_notelist_as: %s" % dirname)
         self.notelist.save(dirname)
         self.dirname = dirname
+        self.watch_notelist()
+
+    def load_interface(self, root):
+        """Build the widget tree of one top level widget in the Glade file
+        
+        The file is read only once, and only the widgets under 'root'
+        are built, so that windows don't pay for dialogs they may never
+        show.
+        
+        """
+        if self.glade_buffer is None:
+            f = file(GLADE, "r")
+            self.glade_buffer = f.read()
+            f.close()
+        return gtk.glade.xml_new_from_buffer(self.glade_buffer,
+                                             len(self.glade_buffer), root)
 
     def new_window(self):
         """Create a new window showing the note list"""
@@ -595,6 +3339,8 @@ class App:
         if w in self.windows:
             self.windows.remove(w)
         if not self.windows:
+            self.unwatch_notelist()
+            self.notelist.flush(self.QUIT_TIMEOUT)
             self.quit()
 
 
@@ -612,19 +3358,29 @@ class StatusInfo:
     def __init__(self, status_label):
         self.widget = status_label
         self.match_count = 0
+        self.searching = False
         
     def get_match_count(self):
         """Return the current match count"""
         return self.match_count
         
-    def set_match_count(self, match_count):
-        """Update the status information with the new match count"""
+    def set_match_count(self, match_count, searching=False):
+        """Update the status information with the new match count
+        
+        If 'searching' is true, the search is still going on, and the
+        count is only partial.
+        
+        """
         self.match_count = match_count
+        self.searching = searching
         self.format()
         
     def format(self):
         """Format information and update it on-screen"""
-        text = "%d matching notes" % self.match_count
+        if self.searching:
+            text = "%d matching notes so far..." % self.match_count
+        else:
+            text = "%d matching notes" % self.match_count
         self.widget.set_text(text)
 
 
@@ -645,22 +3401,27 @@ class Window:
     
     """
 
+    # How long, in seconds, a search may run before letting the main
+    # loop handle other events, such as key presses.
+    SEARCH_TIME_SLICE = 0.02
+
     def __init__(self, app):
         logging.debug("Creating new Window %s" % self)
     
         self.app = app
 
-        xml = gtk.glade.XML(GLADE)
+        xml = app.load_interface("window")
 
         # Allocate a new visibility column for us. That column determines
         # which notes we show, and is updated whenever the search pattern
         # changes.
         self.visibility_column = app.notelist.add_visibility_column()
 
-        # Create a new GtkTreeModelFilter that references our visibility
+        # Create a new GtkTreeModelFilter that uses our visibility
         # column.
         self.filter = app.notelist.liststore.filter_new()
-        self.filter.set_visible_column(self.visibility_column)
+        self.filter.set_visible_func(app.notelist.row_is_visible,
+                                     self.visibility_column)
 
         # Set up the GtkTreeView widget to show the title column in the
         # GtkListStore.
@@ -726,15 +3487,20 @@ class Window:
        
         self.set_sensitives_to(False)
         
+        # The search currently going on, if any: a generator from
+        # NoteList.mark_visible_rows_in_steps, and the id of the idle
+        # callback that continues it.
+        self.search_job = None
+        self.search_idle_id = None
         self.refilter()
 
+        # The dialogs are created when first needed, see load_dialog.
         self.about_dialog = None
         self.about_menuitem = xml.get_widget("about")
-        self.open_dialog = xml.get_widget("open_dialog")
-        self.save_as_dialog = xml.get_widget("save_as_dialog")
-        
-        self.delete_dialog = xml.get_widget("delete_dialog")
-        self.delete_label = xml.get_widget("delete_label")
+        self.open_dialog = None
+        self.save_as_dialog = None
+        self.delete_dialog = None
+        self.delete_label = None
 
         # This bit of code constructs a list of methods for binding to
         # GTK+ signals. This way, we don't have to maintain a list
@@ -754,15 +3520,24 @@ class Window:
         
         """
         logging.debug("Closing window %s" % self)
+        self.stop_search()
         self.app.notelist.remove_visibility_column(self.visibility_column)
         self.app.forget_window(self)
 
     def select_note(self, note):
-        """Select a new note, or select no note"""
+        """Select a new note, or select no note
+        
+        The selected note is pinned, so that its buffer is kept while
+        it is being shown.
+        
+        """
+        if self.selected_note:
+            self.selected_note.unpin()
         self.selected_note = note
         if note:
+            note.pin()
             self.set_sensitives_to(True)
-            self.textview.set_buffer(note.buffer)
+            self.textview.set_buffer(note.get_buffer())
         else:
             self.set_sensitives_to(False)
             self.textview.set_buffer(self.empty_buffer)
@@ -793,14 +3568,53 @@ class Window:
         This should be called whenever the search field changes, or the
         search results need to be updated for other reasons.
         
+        The search is done in slices of at most SEARCH_TIME_SLICE
+        seconds, from idle callbacks in the main loop, so that the user
+        interface stays responsive. The first slice is done at once; for
+        small note lists, that finishes the search. Any search still
+        going on is cancelled.
+        
+        """
+        self.stop_search()
+        self.search_job = self.app.notelist.mark_visible_rows_in_steps(
+                            self.visibility_column, self.get_search_pattern())
+        if self.continue_search():
+            self.search_idle_id = gobject.idle_add(self.continue_search)
+
+    def continue_search(self):
+        """Do one slice of the current search
+        
+        Return True if there is still more to do, False if the search
+        is finished.
+        
         """
-        self.app.notelist.mark_visible_rows(self.visibility_column,
-                                            self.get_search_pattern())
-        self.update_match_count()
+        if self.search_job is None:
+            return False
+        deadline = time.time() + self.SEARCH_TIME_SLICE
+        try:
+            while True:
+                count = self.search_job.next()
+                if time.time() >= deadline:
+                    break
+        except StopIteration:
+            self.stop_search()
+            self.update_match_count()
+            return False
+        self.status.set_match_count(count, searching=True)
+        return True
+
+    def stop_search(self):
+        """Cancel the search that is going on, if any"""
+        if self.search_idle_id is not None:
+            gobject.source_remove(self.search_idle_id)
+            self.search_idle_id = None
+        self.search_job = None
 
     def update_match_count(self):
         """Update the match count based on the current list of matches"""
-        self.status.set_match_count(len(self.get_matching_notes()))
+        notelist = self.app.notelist
+        self.status.set_match_count(
+            notelist.get_visible_count(self.visibility_column))
 
     def get_matching_notes(self):
         """Return list of notes marked as matching
@@ -825,7 +3639,8 @@ class Window:
         if search_text:
             note = Note()
             note.set_text(search_text + "\n")
-            note.buffer.place_cursor(note.buffer.get_end_iter())
+            buffer = note.get_buffer()
+            buffer.place_cursor(buffer.get_end_iter())
             self.app.notelist.append_note(note)
             self.refilter()
             self.select_note(note)
@@ -837,6 +3652,32 @@ class Window:
             w.set_sensitive(setting)
         self.textview.set_property("can-focus", setting)
 
+    def load_dialog(self, name):
+        """Build a dialog from the Glade file, and return its widget tree
+        
+        The dialog is stored in the attribute with the same name.
+        
+        """
+        xml = self.app.load_interface(name)
+        setattr(self, name, xml.get_widget(name))
+        return xml
+
+    def create_open_dialog(self):
+        """Create the File/Open dialog, if it doesn't exist yet"""
+        if self.open_dialog is None:
+            self.load_dialog("open_dialog")
+
+    def create_save_as_dialog(self):
+        """Create the File/Save as dialog, if it doesn't exist yet"""
+        if self.save_as_dialog is None:
+            self.load_dialog("save_as_dialog")
+
+    def create_delete_dialog(self):
+        """Create the dialog for deleting a note, if it doesn't exist yet"""
+        if self.delete_dialog is None:
+            xml = self.load_dialog("delete_dialog")
+            self.delete_label = xml.get_widget("delete_label")
+
     def create_about_dialog(self):
         """Create a new About dialog"""
         if self.about_dialog is None:
@@ -870,22 +3711,24 @@ class Window:
 
     def on_cut_activate(self, *args):
         """Cut selected text in the text editor to the clipboard"""
-        self.selected_note.buffer.cut_clipboard(self.clipboard, True)
+        self.selected_note.get_buffer().cut_clipboard(self.clipboard, True)
 
     def on_copy_activate(self, *args):
         """Copy selected text in text editor to the clipboard"""
-        self.selected_note.buffer.copy_clipboard(self.clipboard)
+        self.selected_note.get_buffer().copy_clipboard(self.clipboard)
 
     def on_paste_activate(self, *args):
         """Paste the clipboard to the text editor"""
-        self.selected_note.buffer.paste_clipboard(self.clipboard, None, True)
+        self.selected_note.get_buffer().paste_clipboard(self.clipboard, None,
+                                                        True)
 
     def on_clear_activate(self, *args):
         """Clear selection in the text editor"""
         if self.selected_note:
-            mark = self.selected_note.buffer.get_mark("insert")
-            iter = self.selected_note.buffer.get_iter_at_mark(mark)
-            self.selected_note.buffer.select_range(iter, iter)
+            buffer = self.selected_note.get_buffer()
+            mark = buffer.get_mark("insert")
+            iter = buffer.get_iter_at_mark(mark)
+            buffer.select_range(iter, iter)
 
     def on_save_activate(self, *args):
         """Save the note list
@@ -902,6 +3745,7 @@ class Window:
         
         """
         logging.debug("Window.on_open_activate called")
+        self.create_open_dialog()
         result = self.open_dialog.run()
         self.open_dialog.hide()
         logging.debug("Window.on_open_activate: result = %s" % result)
@@ -915,6 +3759,7 @@ class Window:
         This implements the "File/Save as" menu entry.
         
         """
+        self.create_save_as_dialog()
         result = self.save_as_dialog.run()
         self.save_as_dialog.hide()
         if result == gtk.RESPONSE_OK:
@@ -945,6 +3790,7 @@ class Window:
         """"Delete selected note"""
         if self.selected_note:
             title = self.selected_note.get_title()
+            self.create_delete_dialog()
             self.delete_label.set_markup('Do you want to remove the note ' +
                                          'titled <b>"%s"</b>?' % title)
         
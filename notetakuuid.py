@@ -2,11 +2,14 @@ r"""UUID objects (universally unique identifiers) according to RFC 4122.
 
 This module provides immutable UUID objects (class UUID) and the functions
 uuid1(), uuid3(), uuid4(), uuid5() for generating version 1, 3, 4, and 5
-UUIDs as specified in RFC 4122.
+UUIDs as specified in RFC 4122, and uuid7() for generating time-ordered
+version 7 UUIDs in the layout later added to the standard.
 
 If all you want is a unique ID, you should probably call uuid1() or uuid4().
 Note that uuid1() may compromise privacy since it creates a UUID containing
-the computer's network address.  uuid4() creates a random UUID.
+the computer's network address.  uuid4() creates a random UUID.  uuid7()
+creates a UUID that sorts after all UUIDs made before it by this process,
+both as an integer and as a string.
 
 Typical usage:
 
@@ -49,6 +52,8 @@ __author__ = 'Ka-Ping Yee <ping@zesty.ca>'
 __date__ = '$Date: 2006/06/12 23:15:40 $'.split()[1].replace('/', '-')
 __version__ = '$Revision: 1.30 $'.split()[1]
 
+import struct
+
 RESERVED_NCS, RFC_4122, RESERVED_MICROSOFT, RESERVED_FUTURE = [
     'reserved for NCS compatibility', 'specified in RFC 4122',
     'reserved for Microsoft compatibility', 'reserved for future definition']
@@ -91,10 +96,16 @@ class UUID(object):
         variant     the UUID variant (one of the constants RESERVED_NCS,
                     RFC_4122, RESERVED_MICROSOFT, or RESERVED_FUTURE)
 
-        version     the UUID version number (1 through 5, meaningful only
-                    when the variant is RFC_4122)
+        version     the UUID version number (1 through 5, or 7, meaningful
+                    only when the variant is RFC_4122)
+
+    The canonical string form is computed once and then cached, since
+    note ids are converted to strings over and over.  UUIDs use slots
+    rather than a dictionary, to keep them small.
     """
 
+    __slots__ = ('int', '_str')
+
     def __init__(self, hex=None, bytes=None, fields=None, int=None,
                        version=None):
         r"""Create a UUID from either a string of 32 hexadecimal digits,
@@ -121,16 +132,25 @@ class UUID(object):
 
         if [hex, bytes, fields, int].count(None) != 3:
             raise TypeError('need just one of hex, bytes, fields, or int')
+        canonical = None
         if hex is not None:
+            if (len(hex) == 36 and hex == hex.lower() and
+                hex[8] == hex[13] == hex[18] == hex[23] == '-'):
+                canonical = hex
             hex = hex.replace('urn:', '').replace('uuid:', '')
             hex = hex.strip('{}').replace('-', '')
             if len(hex) != 32:
                 raise ValueError('badly formed hexadecimal UUID string')
+            # long() also takes spaces, signs and '0x', which must not
+            # end up in the cached string.
+            if canonical is not None and hex.strip('0123456789abcdef'):
+                canonical = None
             int = long(hex, 16)
         if bytes is not None:
             if len(bytes) != 16:
                 raise ValueError('bytes is not a 16-char string')
-            int = long(('%02x'*16) % tuple(map(ord, bytes)), 16)
+            high, low = struct.unpack('>QQ', bytes)
+            int = (high << 64L) | low
         if fields is not None:
             if len(fields) != 6:
                 raise ValueError('fields is not a 6-tuple')
@@ -155,7 +175,7 @@ class UUID(object):
             if not 0 <= int < 1<<128L:
                 raise ValueError('int is out of range (need a 128-bit value)')
         if version is not None:
-            if not 1 <= version <= 5:
+            if not (1 <= version <= 5 or version == 7):
                 raise ValueError('illegal version number')
             # Set the variant to RFC 4122.
             int &= ~(0xc000 << 48L)
@@ -163,7 +183,9 @@ class UUID(object):
             # Set the version number.
             int &= ~(0xf000 << 64L)
             int |= version << 76L
-        self.__dict__['int'] = int
+            canonical = None
+        object.__setattr__(self, 'int', int)
+        object.__setattr__(self, '_str', canonical)
 
     def __cmp__(self, other):
         if isinstance(other, UUID):
@@ -182,16 +204,25 @@ class UUID(object):
     def __setattr__(self, name, value):
         raise TypeError('UUID objects are immutable')
 
+    def __getstate__(self):
+        # A tuple, because pickle skips __setstate__ for a false state,
+        # such as the int of UUID(int=0).
+        return (self.int,)
+
+    def __setstate__(self, state):
+        object.__setattr__(self, 'int', state[0])
+        object.__setattr__(self, '_str', None)
+
     def __str__(self):
-        hex = '%032x' % self.int
-        return '%s-%s-%s-%s-%s' % (
-            hex[:8], hex[8:12], hex[12:16], hex[16:20], hex[20:])
+        if self._str is None:
+            hex = '%032x' % self.int
+            object.__setattr__(self, '_str', '%s-%s-%s-%s-%s' % (
+                hex[:8], hex[8:12], hex[12:16], hex[16:20], hex[20:]))
+        return self._str
 
     def get_bytes(self):
-        bytes = ''
-        for shift in range(0, 128, 8):
-            bytes = chr((self.int >> shift) & 0xff) + bytes
-        return bytes
+        return struct.pack('>QQ', self.int >> 64L, 
+                           self.int & 0xffffffffffffffffL)
 
     bytes = property(get_bytes)
 
@@ -272,6 +303,28 @@ class UUID(object):
 
     version = property(get_version)
 
+def _from_int(int):
+    """Make a UUID from a 128-bit integer known to be in range, skipping
+    the checks and conversions of the UUID constructor."""
+    uuid = object.__new__(UUID)
+    object.__setattr__(uuid, 'int', int)
+    object.__setattr__(uuid, '_str', None)
+    return uuid
+
+def _ints_from_bytes(buffer):
+    """Convert a string of 16-byte big-endian values to 128-bit integers."""
+    if len(buffer) % 16:
+        raise ValueError('buffer is not a multiple of 16 bytes long')
+    words = struct.unpack('>%dQ' % (len(buffer) // 8), buffer)
+    return [(words[i] << 64L) | words[i + 1] 
+            for i in range(0, len(words), 2)]
+
+def uuids_from_bytes(buffer):
+    """Make a list of UUIDs from a string of raw bytes, 16 per UUID, as in
+    a buffer read from a file or socket.  This is much faster than calling
+    UUID(bytes=...) for each slice of the buffer."""
+    return [_from_int(int) for int in _ints_from_bytes(buffer)]
+
 def _ifconfig_getnode():
     """Get the hardware address on Unix by running ifconfig."""
     import os
@@ -338,44 +391,118 @@ def _netbios_getnode():
 
 # Thanks to Thomas Heller for ctypes and for his help with its use here.
 
-# If ctypes is available, use it to find system routines for UUID generation.
+# If ctypes is available, it is used to find system routines for UUID
+# generation.  Looking for them can run ldconfig or gcc, so it is only done
+# when a UUID is first made, and the libraries found are remembered in a
+# cache file for later runs.  The cache file is named by cache_filename, or
+# is in $XDG_CACHE_HOME (~/.cache) if that is None.
 _uuid_generate_random = _uuid_generate_time = _UuidCreate = None
-try:
-    import ctypes, ctypes.util
+_buffer = None
+_backends_loaded = False
+_CACHE_MAGIC = 'notetakuuid-backend 1'
+cache_filename = None
+
+def _get_cache_filename():
+    import os
+    if cache_filename is not None:
+        return cache_filename
+    dirname = (os.environ.get('XDG_CACHE_HOME') or
+               os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(dirname, 'notetakuuid-backend')
+
+def _read_backend_cache():
+    """Return the library paths remembered from an earlier run, or None."""
+    try:
+        f = open(_get_cache_filename())
+        lines = f.read().splitlines()
+        f.close()
+    except (IOError, OSError):
+        return None
+    if not lines or lines[0] != _CACHE_MAGIC:
+        return None
+    return lines[1:]
+
+def _write_backend_cache(paths):
+    """Remember the library paths, if the cache file can be written."""
+    import os
+    filename = _get_cache_filename()
+    try:
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        f = open(filename, 'w')
+        f.write('\n'.join([_CACHE_MAGIC] + paths) + '\n')
+        f.close()
+    except (IOError, OSError):
+        pass
+
+def _load_backends(use_cache=True):
+    """Find the system routines for UUID generation, the first time this
+    is called.  An empty list of libraries in the cache means that there
+    are none, and os.urandom is used without looking again."""
+    global _uuid_generate_random, _uuid_generate_time, _UuidCreate
+    global _buffer, _backends_loaded
+    if _backends_loaded:
+        return
+    _backends_loaded = True
+    try:
+        import ctypes, ctypes.util
+    except:
+        return
     _buffer = ctypes.create_string_buffer(16)
 
     # The uuid_generate_* routines are provided by libuuid on at least
     # Linux and FreeBSD, and provided by libc on Mac OS X.
-    for libname in ['uuid', 'c']:
+    paths = None
+    if use_cache:
+        paths = _read_backend_cache()
+    cached = paths is not None
+    if not cached:
+        paths = [ctypes.util.find_library(libname)
+                 for libname in ['uuid', 'c']]
+    found = []
+    for path in paths:
         try:
-            lib = ctypes.CDLL(ctypes.util.find_library(libname))
+            lib = ctypes.CDLL(path)
         except:
             continue
         if hasattr(lib, 'uuid_generate_random'):
             _uuid_generate_random = lib.uuid_generate_random
         if hasattr(lib, 'uuid_generate_time'):
             _uuid_generate_time = lib.uuid_generate_time
+        if (hasattr(lib, 'uuid_generate_random') or
+            hasattr(lib, 'uuid_generate_time')):
+            found.append(path)
+    if not cached:
+        _write_backend_cache(found)
+    elif len(found) != len(paths):
+        # A library has gone away since the cache was written, so look
+        # for them again.
+        _uuid_generate_random = _uuid_generate_time = None
+        _backends_loaded = False
+        return _load_backends(use_cache=False)
 
     # On Windows prior to 2000, UuidCreate gives a UUID containing the
     # hardware address.  On Windows 2000 and later, UuidCreate makes a
     # random UUID and UuidCreateSequential gives a UUID containing the
     # hardware address.  These routines are provided by the RPC runtime.
-    try:
-        lib = ctypes.windll.rpcrt4
-    except:
-        lib = None
-    _UuidCreate = getattr(lib, 'UuidCreateSequential',
-                          getattr(lib, 'UuidCreate', None))
-except:
-    pass
+    import sys
+    if sys.platform == 'win32':
+        try:
+            lib = ctypes.windll.rpcrt4
+        except:
+            lib = None
+        _UuidCreate = getattr(lib, 'UuidCreateSequential',
+                              getattr(lib, 'UuidCreate', None))
 
 def _unixdll_getnode():
     """Get the hardware address on Unix using ctypes."""
+    _load_backends()
     _uuid_generate_time(_buffer)
     return UUID(bytes=_buffer.raw).node
 
 def _windll_getnode():
     """Get the hardware address on Windows using ctypes."""
+    _load_backends()
     if _UuidCreate(_buffer) == 0:
         return UUID(bytes=_buffer.raw).node
 
@@ -418,6 +545,7 @@ def uuid1(node=None, clock_seq=None):
 
     # When the system provides a version-1 UUID generator, use it (but don't
     # use UuidCreate here because its UUIDs don't conform to RFC 4122).
+    _load_backends()
     if _uuid_generate_time and node is clock_seq is None:
         _uuid_generate_time(_buffer)
         return UUID(bytes=_buffer.raw)
@@ -450,6 +578,7 @@ def uuid4():
     """Generate a random UUID."""
 
     # When the system provides a version-4 UUID generator, use it.
+    _load_backends()
     if _uuid_generate_random:
         _uuid_generate_random(_buffer)
         return UUID(bytes=_buffer.raw)
@@ -460,9 +589,56 @@ def uuid4():
         return UUID(bytes=os.urandom(16), version=4)
     except:
         import random
-        bytes = [chr(random.randrange(256)) for i in range(16)]
+        bytes = ''.join([chr(random.randrange(256)) for i in range(16)])
         return UUID(bytes=bytes, version=4)
 
+_VERSION4_CLEAR = ~((0xc000 << 48L) | (0xf000 << 64L))
+_VERSION4_SET = (0x8000 << 48L) | (4 << 76L)
+
+def uuid4_batch(count):
+    """Generate a list of 'count' random UUIDs.  The randomness for all of
+    them is read at once, and their version and variant bits are set
+    without going through the UUID constructor."""
+    try:
+        import os
+        buffer = os.urandom(16 * count)
+    except:
+        import random
+        buffer = ''.join([chr(random.randrange(256))
+                          for i in range(16 * count)])
+    return [_from_int((int & _VERSION4_CLEAR) | _VERSION4_SET)
+            for int in _ints_from_bytes(buffer)]
+
+_last_v7 = [0, 0]
+
+def uuid7():
+    """Generate a time-ordered UUID: 48 bits of Unix time in milliseconds,
+    the version, a 12-bit counter for UUIDs made within the same
+    millisecond, the variant, and 62 random bits.  If the clock goes
+    backwards, or the counter runs out, the time of the previous UUID is
+    used or advanced, so that UUIDs keep increasing."""
+    import time
+    millis = long(time.time() * 1000)
+    last_millis, counter = _last_v7
+    if millis > last_millis:
+        counter = 0
+    else:
+        millis = last_millis
+        counter += 1
+        if counter > 0xfff:
+            millis += 1
+            counter = 0
+    _last_v7[:] = [millis, counter]
+    try:
+        import os
+        random_bits = struct.unpack('>Q', os.urandom(8))[0]
+    except:
+        import random
+        random_bits = random.getrandbits(64)
+    int = ((millis & 0xffffffffffffL) << 80L) | (counter << 64L) | \
+          (random_bits & 0x3fffffffffffffffL)
+    return UUID(int=int, version=7)
+
 def uuid5(namespace, name):
     """Generate a UUID from the SHA-1 hash of a namespace UUID and a name."""
     import sha
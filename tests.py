@@ -3,7 +3,13 @@
 
 import filecmp
 import os
+import pickle
 import shutil
+import stat
+import StringIO
+import subprocess
+import sys
+import tarfile
 import tempfile
 import time
 import unittest
@@ -29,9 +35,19 @@ def read_file(filename):
     return data
 
 
+def count_saves(notes, saved):
+    """Make each note append itself to 'saved' whenever it is saved"""
+    for note in notes:
+        def save(filename, note=note, original=note.save):
+            saved.append(note)
+            original(filename)
+        note.save = save
+
+
 def get_mark_offset(note, mark_name):
-    mark = note.buffer.get_mark(mark_name)
-    iter = note.buffer.get_iter_at_mark(mark)
+    buffer = note.get_buffer()
+    mark = buffer.get_mark(mark_name)
+    iter = buffer.get_iter_at_mark(mark)
     return iter.get_offset()
 
 
@@ -43,6 +59,168 @@ class GlobalVariableTestst(unittest.TestCase):
         self.failUnless(os.path.exists(GLADE))
 
 
+
+class UuidTests(unittest.TestCase):
+
+    def setUp(self):
+        self.string = "12345678-1234-5678-1234-567812345678"
+        self.bytes = "\x12\x34\x56\x78" * 4
+
+    def testBytes(self):
+        u = uuid.UUID(bytes=self.bytes)
+        self.failUnlessEqual(str(u), self.string)
+        self.failUnlessEqual(u.bytes, self.bytes)
+        self.failUnlessEqual(uuid.UUID(self.string), u)
+
+    def testHasNoDict(self):
+        self.failIf(hasattr(uuid.UUID(self.string), "__dict__"))
+
+    def testOnlyHexDigitsAreCached(self):
+        for prefix in [" ", "+", "0x"]:
+            string = prefix + self.string[len(prefix):]
+            u = uuid.UUID(string)
+            self.failUnlessEqual(str(u), str(uuid.UUID(int=u.int)))
+
+    def testPickle(self):
+        for u in [uuid.UUID(self.string), uuid.UUID(int=0)]:
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                copy = pickle.loads(pickle.dumps(u, protocol))
+                self.failUnlessEqual(copy, u)
+                self.failUnlessEqual(str(copy), str(u))
+
+    def testUuidsFromBytes(self):
+        uuids = uuid.uuids_from_bytes(self.bytes * 3)
+        self.failUnlessEqual([str(u) for u in uuids], [self.string] * 3)
+        self.failUnlessRaises(ValueError, uuid.uuids_from_bytes, "x")
+
+    def testUuid7(self):
+        uuids = [uuid.uuid7() for i in range(1000)]
+        self.failUnlessEqual(sorted(uuids), uuids)
+        self.failUnlessEqual(sorted([str(u) for u in uuids]), 
+                             [str(u) for u in uuids])
+        self.failUnlessEqual(len(set(uuids)), 1000)
+        self.failUnlessEqual(uuids[0].version, 7)
+        self.failUnlessEqual(uuids[0].variant, uuid.RFC_4122)
+        self.failUnlessEqual(uuid.UUID(int=0, version=7).version, 7)
+        self.failUnlessRaises(ValueError, uuid.UUID, int=0, version=6)
+
+    def testUuid4Batch(self):
+        uuids = uuid.uuid4_batch(10)
+        self.failUnlessEqual(len(set(uuids)), 10)
+        self.failUnlessEqual(set([u.version for u in uuids]), set([4]))
+        self.failUnlessEqual(set([u.variant for u in uuids]), 
+                             set([uuid.RFC_4122]))
+
+    def testImportDoesNotLoadBackends(self):
+        # Importing must not look for the native UUID libraries, which
+        # may run other programs, nor even load ctypes. How long the
+        # import takes depends on the machine, so the time limit is
+        # generous and applies to the best of a few runs.
+        budget = 1.0
+        tempdir = tempfile.mkdtemp()
+        env = dict(os.environ)
+        env["XDG_CACHE_HOME"] = tempdir
+        script = ("import sys, time; started = time.time(); "
+                  "import notetakuuid; "
+                  "print time.time() - started, "
+                  "notetakuuid._backends_loaded, "
+                  "'ctypes' in sys.modules, 'ctypes.util' in sys.modules")
+        cwd = os.path.dirname(uuid.__file__) or "."
+        times = []
+        try:
+            for i in range(3):
+                p = subprocess.Popen([sys.executable, "-c", script], 
+                                     stdout=subprocess.PIPE, env=env,
+                                     cwd=cwd)
+                output = p.communicate()[0].split()
+                self.failUnlessEqual(output[1:], ["False"] * 3)
+                times.append(float(output[0]))
+        finally:
+            shutil.rmtree(tempdir)
+        self.failUnless(min(times) < budget)
+
+    def testBackendsAreCached(self):
+        tempdir = tempfile.mkdtemp()
+        uuid.cache_filename = os.path.join(tempdir, "cache", "backend")
+        uuid._backends_loaded = False
+        try:
+            uuid.uuid4()
+            lines = file(uuid.cache_filename).read().splitlines()
+        finally:
+            uuid.cache_filename = None
+            shutil.rmtree(tempdir)
+        self.failUnlessEqual(lines[0], "notetakuuid-backend 1")
+
+class WriteFileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, "pink.note")
+        create_file(self.filename, "pink\n", 12765)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def testWrite(self):
+        write_file(self.filename, "pretty\n", 65535)
+        sync_directory(self.dirname)
+        self.failUnlessEqual(read_file(self.filename), "pretty\n")
+        self.failUnlessEqual(os.stat(self.filename).st_mtime, 65535)
+        self.failUnlessEqual(os.listdir(self.dirname), ["pink.note"])
+
+    def testFailedWriteKeepsOldContents(self):
+        self.failUnlessRaises(TypeError, write_file, self.filename, None)
+        self.failUnlessEqual(read_file(self.filename), "pink\n")
+        self.failUnlessEqual(os.listdir(self.dirname), ["pink.note"])
+
+    def testWriteKeepsPermissions(self):
+        os.chmod(self.filename, 0600)
+        write_file(self.filename, "pretty\n")
+        self.failUnlessEqual(read_file(self.filename), "pretty\n")
+        self.failUnlessEqual(stat.S_IMODE(os.stat(self.filename).st_mode),
+                             0600)
+
+    def testTempFilename(self):
+        temp = temp_filename(self.filename)
+        self.failUnlessEqual(os.path.dirname(temp), self.dirname)
+        self.failUnless(is_temp_filename(os.path.basename(temp)))
+        self.failIf(is_temp_filename("pink.note"))
+
+    def testMakeParentDirectory(self):
+        filename = os.path.join(self.dirname, "ab", "cd", "abcd.note")
+        make_parent_directory(filename)
+        make_parent_directory(filename)
+        self.failUnless(os.path.isdir(os.path.dirname(filename)))
+
+
+
+class MapInThreadsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+
+    def square(self, i):
+        # Make later items finish first, to check the order is kept.
+        time.sleep((20 - i) * 0.001)
+        return i * i
+
+    def testKeepsOrderInBatches(self):
+        map_in_threads(self.square, range(20), 4, 8, self.batches.append)
+        self.failUnlessEqual([len(batch) for batch in self.batches], 
+                             [8, 8, 4])
+        self.failUnlessEqual(sum(self.batches, []), 
+                             [i * i for i in range(20)])
+
+    def testWithoutThreads(self):
+        map_in_threads(self.square, range(5), 1, 2, self.batches.append)
+        self.failUnlessEqual(self.batches, [[0, 1], [4, 9], [16]])
+
+    def testRaisesExceptionOfFunction(self):
+        self.failUnlessRaises(ZeroDivisionError, map_in_threads, 
+                              lambda i: 1 / i, range(5), 4, 2, 
+                              self.batches.append)
+        self.failUnlessEqual(self.batches, [])
+
 class NoteTests(unittest.TestCase):
 
     def setUp(self):
@@ -79,14 +257,40 @@ class NoteTests(unittest.TestCase):
         
         self.failUnlessEqual(note.id, self.id)
         self.failUnlessEqual(note.mtime, self.mtime)
-        self.failIfEqual(note.buffer, None)
+        self.failUnlessEqual(note.buffer, None)
+        self.failUnlessEqual(note.get_text(), self.contents)
+        self.failUnlessEqual(note.get_title(), self.title)
+        self.failUnlessEqual(note.dirty, False)
         
-        start, end = note.buffer.get_bounds()
-        self.failUnlessEqual(note.buffer.get_text(start, end), self.contents)
+        buffer = note.get_buffer()
+        start, end = buffer.get_bounds()
+        self.failUnlessEqual(buffer.get_text(start, end), self.contents)
+        self.failUnlessEqual(note.dirty, False)
         
         self.failUnlessEqual(get_mark_offset(note, "insert"), 0)
         self.failUnlessEqual(get_mark_offset(note, "selection_bound"), 0)
 
+    def testCreateWithId(self):
+        self.failUnlessEqual(Note("pink").id, "pink")
+        self.failIfEqual(Note().id, Note().id)
+
+    def testNewIdsAreTimeOrdered(self):
+        ids = [Note().id for i in range(100)]
+        self.failUnlessEqual(sorted(ids), ids)
+        self.failUnlessEqual(uuid.UUID(ids[0]).version, 7)
+
+    def testLoadLazily(self):
+        note = Note()
+        note.load_lazily(self.filename, self.title, len(self.contents),
+                         self.mtime, "digest")
+        self.failUnlessEqual(note.id, self.id)
+        self.failUnlessEqual(note.mtime, self.mtime)
+        self.failIf(note.is_loaded())
+        self.failUnlessEqual(note.get_title(), self.title)
+        self.failUnlessEqual(note.get_text(), self.contents)
+        self.failUnless(note.is_loaded())
+        self.failIfEqual(note.digest, "digest")
+
     def testLoadWithoutDotNoteInFilename(self):
         note = Note()
         note.load("/dev/null")
@@ -139,7 +343,7 @@ class NoteTests(unittest.TestCase):
         note = Note()
         note.load(self.filename)
         self.failUnless(note.mtime < time.time())
-        note.buffer.set_text("new stuff")
+        note.get_buffer().set_text("new stuff")
         self.failUnless(time.time() - note.mtime <= 1.0)
 
     def remember_timestamp(self, note):
@@ -188,10 +392,46 @@ class NoteTests(unittest.TestCase):
         self.failUnlessEqual(self.timestamp, None)
         self.failUnlessEqual(self.timestamp_note, None)
 
+    def testReleaseBuffer(self):
+        note = Note()
+        note.load(self.filename)
+        note.get_buffer().set_text("new stuff")
+        self.failUnless(note.release_buffer())
+        self.failUnlessEqual(note.buffer, None)
+        self.failUnlessEqual(note.get_text(), "new stuff")
+        self.failUnlessEqual(note.dirty, True)
+
+    def testPinnedBufferIsNotReleased(self):
+        note = Note()
+        note.load(self.filename)
+        note.get_buffer()
+        note.pin()
+        self.failIf(note.release_buffer())
+        self.failIfEqual(note.buffer, None)
+        note.unpin()
+        self.failUnless(note.release_buffer())
+
+    def remember_edit(self, note, kind, *args):
+        self.edits.append((kind,) + args)
+
+    def testEditCallback(self):
+        note = Note()
+        note.load(self.filename)
+        self.edits = []
+        note.set_edit_callback(self.remember_edit)
+        note.set_text("pink")
+        buffer = note.get_buffer()
+        buffer.insert(buffer.get_end_iter(), " note")
+        buffer.delete(buffer.get_start_iter(), buffer.get_iter_at_offset(5))
+        self.failUnlessEqual(self.edits, [("set", "pink"), 
+                                          ("insert", 4, " note"),
+                                          ("delete", 0, 5)])
+        self.failUnlessEqual(note.get_text(), "note")
+
     def testDirtyFromBufferChange(self):
         note = Note()
         note.load(self.filename)
-        note.buffer.set_text("new stuff")
+        note.get_buffer().set_text("new stuff")
         self.failUnlessEqual(note.dirty, True)
 
     def testCleanAfterSave(self):
@@ -212,6 +452,266 @@ class NoteTests(unittest.TestCase):
         self.failUnlessEqual(note.matches(["pink", "pretty"]), True)
 
 
+class BufferCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = BufferCache(2)
+        self.notes = []
+        for text in ["one", "two", "three"]:
+            note = Note()
+            note.set_text(text)
+            note.set_buffer_cache(self.cache)
+            self.notes.append(note)
+
+    def testLeastRecentlyUsedIsReleased(self):
+        one, two, three = self.notes
+        one.get_buffer()
+        two.get_buffer()
+        one.get_buffer()
+        three.get_buffer()
+        self.failIfEqual(one.buffer, None)
+        self.failUnlessEqual(two.buffer, None)
+        self.failIfEqual(three.buffer, None)
+        self.failUnlessEqual(two.get_text(), "two")
+
+    def testPinnedIsKept(self):
+        one, two, three = self.notes
+        one.get_buffer()
+        one.pin()
+        two.get_buffer()
+        three.get_buffer()
+        self.failIfEqual(one.buffer, None)
+        self.failUnlessEqual(two.buffer, None)
+        self.failIfEqual(three.buffer, None)
+
+
+class SearchIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.index = SearchIndex()
+        self.pink = Note()
+        self.pink.set_text("Pink note\nis pretty")
+        self.black = Note()
+        self.black.set_text("black note")
+        self.index.add_note(self.pink)
+        self.index.add_note(self.black)
+
+    def testEmptyPatternMatchesAll(self):
+        self.failUnlessEqual(self.index.find([]),
+                             set([self.pink, self.black]))
+
+    def testFindsSubstrings(self):
+        self.failUnlessEqual(self.index.find(["ink"]), set([self.pink]))
+        self.failUnlessEqual(self.index.find(["note"]),
+                             set([self.pink, self.black]))
+        self.failUnlessEqual(self.index.find(["xyzzy"]), set())
+
+    def testFindsAllWords(self):
+        self.failUnlessEqual(self.index.find(["note", "pretty"]),
+                             set([self.pink]))
+        self.failUnlessEqual(self.index.find(["black", "pretty"]), set())
+
+    def testNegation(self):
+        self.failUnlessEqual(self.index.find(["!pink"]), set([self.black]))
+        self.failUnlessEqual(self.index.find(["note", "!black"]),
+                             set([self.pink]))
+        self.failUnlessEqual(self.index.find(["!"]), set())
+
+    def testWordWithWhitespace(self):
+        self.failUnlessEqual(self.index.find(["note\nis"]), set([self.pink]))
+
+    def testAgreesWithNoteMatches(self):
+        for pattern in [["p"], ["pink", "!pretty"], ["e n"], ["!xyzzy"]]:
+            wanted = set([note for note in [self.pink, self.black]
+                          if note.matches(pattern)])
+            self.failUnlessEqual(self.index.find(pattern), wanted)
+
+    def testUpdate(self):
+        self.black.set_text("black is pretty")
+        self.index.update_note(self.black)
+        self.failUnlessEqual(self.index.find(["pretty"]),
+                             set([self.pink, self.black]))
+        self.failUnlessEqual(self.index.find(["note"]), set([self.pink]))
+
+    def testRemove(self):
+        self.index.remove_note(self.pink)
+        self.failUnlessEqual(self.index.find(["note"]), set([self.black]))
+        self.failIf("pink" in self.index.postings)
+        self.failIf("pin" in self.index.trigram_postings)
+        self.index.remove_note(self.pink)
+
+    def testTrigrams(self):
+        self.failUnlessEqual(self.index.get_trigrams("pink"),
+                             set(["pin", "ink"]))
+        self.failUnlessEqual(self.index.get_trigrams("pi"), set())
+
+    def testCandidatesAreVerified(self):
+        # All trigrams of "abcd" are in the text, but "abcd" is not.
+        self.pink.set_text("abc bcd")
+        self.index.update_note(self.pink)
+        self.failUnlessEqual(self.index.get_candidates("abcd"),
+                             set([self.pink]))
+        self.failUnlessEqual(self.index.find(["abcd"]), set())
+        self.failUnlessEqual(self.index.find(["c b"]), set([self.pink]))
+
+    def testTrigramsUpdatedOnTouch(self):
+        notelist = NoteList()
+        notelist.append_note(self.pink)
+        self.pink.get_buffer().insert(self.pink.get_buffer().get_end_iter(),
+                                      " xyzzy")
+        self.failUnlessEqual(notelist.index.find(["yzz"]), set([self.pink]))
+
+    def testClear(self):
+        self.index.clear()
+        self.failUnlessEqual(self.index.find([]), set())
+
+    def testEmptyPatternDoesNotReadLazyNotes(self):
+        note = Note()
+        note.load_lazily("/nonexistent/pale.note", "pale note", 10, 0, 
+                         "digest")
+        self.index.add_note(note)
+        self.failUnless(note in self.index.find([]))
+        self.failIf(note.is_loaded())
+
+    def testIndexSomeDropsUnreadableNotes(self):
+        note = Note()
+        note.load_lazily("/nonexistent/pale.note", "pale note", 10, 0, 
+                         "digest")
+        self.index.add_note(note)
+        self.failIf(self.index.index_some(10))
+        self.failIf(note in self.index.get_notes())
+        self.failUnlessEqual(self.index.find(["note"]), 
+                             set([self.pink, self.black]))
+
+
+class ProcessSearchIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        if not ProcessSearchIndex.available:
+            return
+        self.index = ProcessSearchIndex(2)
+        self.notes = []
+        for text in ["pink note", "pretty note", "black"]:
+            note = Note()
+            note.set_text(text)
+            self.index.add_note(note)
+            self.notes.append(note)
+
+    def tearDown(self):
+        if ProcessSearchIndex.available:
+            self.index.close()
+
+    def testFind(self):
+        if not ProcessSearchIndex.available:
+            return
+        self.failUnlessEqual(self.index.find([]), set(self.notes))
+        self.failUnlessEqual(self.index.find(["note"]), set(self.notes[:2]))
+        self.failUnlessEqual(self.index.find(["!note"]), set(self.notes[2:]))
+        self.failUnlessEqual(self.index.find(["note"], self.notes[1:]),
+                             set(self.notes[1:2]))
+
+    def testUpdateAndRemove(self):
+        if not ProcessSearchIndex.available:
+            return
+        self.notes[2].set_text("black note")
+        self.index.update_note(self.notes[2])
+        self.index.remove_note(self.notes[0])
+        self.failUnlessEqual(self.index.find(["note"]), set(self.notes[1:]))
+        self.failUnlessEqual(self.index.get_notes(), set(self.notes[1:]))
+
+    def testLazyNotes(self):
+        if not ProcessSearchIndex.available:
+            return
+        note = Note()
+        note.load_lazily("/nonexistent/pale.note", "pale note", 10, 0, 
+                         "digest")
+        self.index.add_note(note)
+        self.failIf(note.is_loaded())
+        self.failUnless(note in self.index.find([]))
+        self.failUnlessEqual(self.index.find(["note"]), set(self.notes[:2]))
+        self.failIf(note in self.index.get_notes())
+
+    def testNoteListUsesIt(self):
+        if not ProcessSearchIndex.available:
+            return
+        notelist = NoteList()
+        for note in self.notes:
+            notelist.append_note(note)
+        notelist.set_search_index(self.index)
+        self.notes[2].set_text("pink again")
+        self.failUnlessEqual(sorted(notelist.find_matching(["pink"])),
+                             sorted([self.notes[0], self.notes[2]]))
+
+
+class SearchStateTests(unittest.TestCase):
+
+    def setUp(self):
+        self.index = SearchIndex()
+        self.notes = []
+        for text in ["project plan", "progress report", "shopping list"]:
+            note = Note()
+            note.set_text(text)
+            self.index.add_note(note)
+            self.notes.append(note)
+        # Some notes that never match, so that the index thinks it is
+        # cheaper to test visible notes one by one.
+        for i in range(20):
+            note = Note()
+            note.set_text("filler %d" % i)
+            self.index.add_note(note)
+        self.state = SearchState()
+        self.tested = []
+        self.real_matches = self.index.matches
+        self.index.matches = self.remember_matches
+
+    def remember_matches(self, note, pattern):
+        self.tested.append(note)
+        return self.real_matches(note, pattern)
+
+    def testNarrows(self):
+        self.failUnless(self.state.narrows(["proj"], ["pro"]))
+        self.failUnless(self.state.narrows(["pro", "list"], ["pro"]))
+        self.failUnless(self.state.narrows(["pro"], []))
+        self.failUnless(self.state.narrows(["!pro"], ["!proj"]))
+        self.failIf(self.state.narrows(["pro"], ["proj"]))
+        self.failIf(self.state.narrows(["!proj"], ["!pro"]))
+        self.failIf(self.state.narrows(["!pro"], ["pro"]))
+        self.failIf(self.state.narrows([], ["pro"]))
+
+    def testRefinementTestsOnlyVisibleNotes(self):
+        self.failUnlessEqual(self.state.search(self.index, ["pro"]),
+                             set(self.notes[:2]))
+        self.tested = []
+        self.failUnlessEqual(self.state.search(self.index, ["proj"]),
+                             set(self.notes[:1]))
+        self.failUnlessEqual(sorted(self.tested), sorted(self.notes[:2]))
+
+    def testBroadeningKeepsVisibleNotes(self):
+        self.state.search(self.index, ["proj"])
+        self.failUnlessEqual(self.state.search(self.index, ["pro"]),
+                             set(self.notes[:2]))
+        self.failIf(self.notes[0] in self.tested)
+
+    def testRefinementRetestsChangedNotes(self):
+        self.state.search(self.index, ["pro"])
+        self.notes[2].set_text("project shopping")
+        self.index.update_note(self.notes[2])
+        self.state.note_changed(self.notes[2])
+        self.failUnlessEqual(self.state.search(self.index, ["proj"]),
+                             set([self.notes[0], self.notes[2]]))
+
+    def testForgetNote(self):
+        self.state.search(self.index, ["pro"])
+        self.state.forget_note(self.notes[0])
+        self.failUnlessEqual(self.state.visible, set(self.notes[1:2]))
+
+    def testReset(self):
+        self.state.search(self.index, ["pro"])
+        self.state.reset()
+        self.failUnlessEqual(self.state.pattern, None)
+        self.failUnlessEqual(self.state.visible, set())
+
+
 class NoteListTestBase(unittest.TestCase):
 
     def setUp(self):
@@ -243,6 +743,10 @@ class NoteListTestBase(unittest.TestCase):
             os.remove(self.filename2)
         if os.path.exists(self.subdir):
             os.rmdir(self.subdir)
+        for basename in [Catalog.FILENAME, Journal.FILENAME]:
+            filename = os.path.join(self.dirname, basename)
+            if os.path.exists(filename):
+                os.remove(filename)
         if os.path.exists(self.dirname):
             os.rmdir(self.dirname)
 
@@ -288,6 +792,29 @@ class NoteListTests(NoteListTestBase):
         note = Note()
         self.failUnlessEqual(notelist.find_iter_for_note(note), None)
 
+    def testFindIterAfterSorting(self):
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        notes = notelist.get_notes()
+        # This moves the first note last in the sorted list.
+        notes[0].set_text("zebra note")
+        self.failUnlessEqual(notelist.get_notes(), [notes[1], notes[0]])
+        for note in notes:
+            iter = notelist.find_iter_for_note(note)
+            self.failUnlessEqual(
+                notelist.liststore.get_value(iter, notelist.NOTE_COLUMN), 
+                note)
+        self.failUnlessEqual(notelist.get_from_title_column(notes[0]), 
+                             "zebra note")
+
+    def testRowsAreForgottenOnRemove(self):
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        note = notelist.get_notes()[0]
+        notelist.remove_note(None, note)
+        self.failIf(note.id in notelist.rows)
+        self.failUnlessEqual(notelist.find_iter_for_note(note), None)
+
     def testNothingInTitleColumnWhenEmpty(self):
         notelist = NoteList()
         note = Note()
@@ -315,9 +842,190 @@ class NoteListTests(NoteListTestBase):
         notelist.load(self.dirname)
         self.failUnlessEqual(len(notelist.get_notes()), 2)
 
+    def testLoadIgnoresTempFiles(self):
+        temp = temp_filename(self.filename1)
+        create_file(temp, "half a note", 0)
+        try:
+            notelist = NoteList()
+            notelist.load(self.dirname)
+        finally:
+            os.remove(temp)
+        self.failUnlessEqual(len(notelist.get_notes()), 2)
+
+    def testLoadReplaysJournal(self):
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        notes = notelist.get_notes()
+        notes[0].get_buffer().insert(notes[0].get_buffer().get_end_iter(),
+                                     "is pretty\n")
+        notes[1].set_text("zebra note\n")
+        # Load again, as if after a crash, without saving.
+        notelist2 = NoteList()
+        notelist2.load(self.dirname)
+        notes2 = notelist2.get_notes()
+        self.failUnlessEqual([note.get_text() for note in notes2],
+                             [notes[0].get_text(), notes[1].get_text()])
+        self.failUnless(notelist2.is_dirty())
+        notelist2.save_dirty(self.dirname)
+        self.failIf(os.path.exists(os.path.join(self.dirname, 
+                                                Journal.FILENAME)))
+        self.failUnlessEqual(read_file(self.filename2), "zebra note\n")
+
+    def testReadOnlyLoadReplaysRemoveWithoutWriting(self):
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        Journal(self.dirname).record(notelist.get_notes()[0], "remove")
+        names = sorted(os.listdir(self.dirname))
+        entries = Catalog(self.dirname).read()
+        notelist2 = NoteList()
+        notelist2.load(self.dirname, read_only=True)
+        self.failUnlessEqual([note.id for note in notelist2.get_notes()],
+                             [self.id2])
+        self.failUnlessEqual(sorted(os.listdir(self.dirname)), names)
+        self.failUnlessEqual(Catalog(self.dirname).read(), entries)
+        notelist2.save(self.dirname)
+        self.failIf(os.path.exists(self.filename1))
+
+    def testMigrate(self):
+        if not SqliteStorage.available:
+            return
+        database = self.dirname + ".sqlite"
+        copy = self.dirname + ".new"
+        try:
+            self.failUnlessEqual(migrate(self.dirname, database), 2)
+            notelist = NoteList()
+            notelist.load(database)
+            self.failUnlessEqual([note.get_title() 
+                                  for note in notelist.get_notes()],
+                                 [self.title1, self.title2])
+            self.failUnlessEqual(notelist.find_matching(["pink"]),
+                                 notelist.get_notes()[:1])
+            notelist.clear()
+            self.failUnlessEqual(migrate(database, copy), 2)
+            self.dirs_are_equal(self.dirname, copy)
+        finally:
+            if os.path.exists(database):
+                os.remove(database)
+            if os.path.exists(copy):
+                shutil.rmtree(copy)
+
+    def testMigrateDoesNotChangeSource(self):
+        copy = self.dirname + ".new"
+        names = sorted(os.listdir(self.dirname))
+        try:
+            self.failUnlessEqual(migrate(self.dirname, copy), 2)
+            self.failUnlessEqual(sorted(os.listdir(self.dirname)), names)
+        finally:
+            shutil.rmtree(copy)
+
+    def testLoadWritesCatalog(self):
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        entries = Catalog(self.dirname).read()
+        self.failUnlessEqual(sorted(entries.keys()), 
+                             [self.id1 + ".note", self.id2 + ".note"])
+        signature, digest, title = entries[self.id1 + ".note"]
+        self.failUnlessEqual(title, self.title1)
+        self.failUnlessEqual(signature[:2], 
+                             (self.mtime1, len(self.title1) + 1))
+
+    def testLoadUsesCatalog(self):
+        NoteList().load(self.dirname)
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        notes = notelist.get_notes()
+        self.failUnlessEqual([note.get_title() for note in notes],
+                             [self.title1, self.title2])
+        self.failIf(notes[0].is_loaded())
+        self.failIf(notes[1].is_loaded())
+        self.failUnlessEqual(notelist.find_matching(["pink"]), [notes[0]])
+        self.failUnless(notes[0].is_loaded())
+
+    def testLoadRereadsChangedFiles(self):
+        NoteList().load(self.dirname)
+        create_file(self.filename1, "zebra note\n", self.mtime1 + 1)
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        notes = notelist.get_notes()
+        self.failUnlessEqual([note.get_title() for note in notes],
+                             [self.title2, "zebra note"])
+        self.failIf(notes[0].is_loaded())
+        self.failUnless(notes[1].is_loaded())
+        entries = Catalog(self.dirname).read()
+        self.failUnlessEqual(entries[self.id1 + ".note"][2], "zebra note")
+
+    def testLoadRebuildsCorruptCatalog(self):
+        filename = os.path.join(self.dirname, Catalog.FILENAME)
+        create_file(filename, "garbage\n", 0)
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        self.failUnlessEqual(len(notelist.get_notes()), 2)
+        self.failUnlessEqual(len(Catalog(self.dirname).read()), 2)
+
+    def testSaveDirtyUpdatesCatalog(self):
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        note = notelist.get_notes()[0]
+        note.set_text("zebra note\n")
+        notelist.save_dirty(self.dirname)
+        entries = Catalog(self.dirname).read()
+        signature, digest, title = entries[self.id1 + ".note"]
+        self.failUnlessEqual(title, "zebra note")
+        self.failUnlessEqual(digest, note.digest)
+        self.failUnlessEqual(signature[0], os.stat(self.filename1).st_mtime)
+
+    def testSaveDirtyWritesOnlyChangedNotes(self):
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        notes = notelist.get_notes()
+        saved = []
+        count_saves(notes, saved)
+        notes[1].set_text("yeehaa")
+        notelist.save_dirty(self.dirname)
+        self.failUnlessEqual(saved, [notes[1]])
+        notelist.save_dirty(self.dirname)
+        self.failUnlessEqual(saved, [notes[1]])
+        self.failIf(notelist.is_dirty())
+
+    def testSaveDirtyRemovesNotesRemovedWithoutDirname(self):
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        note = notelist.get_notes()[0]
+        note.set_text("yeehaa")
+        notelist.remove_note(None, note)
+        self.failUnless(os.path.exists(self.filename1))
+        saved = []
+        count_saves(notelist.get_notes(), saved)
+        notelist.save_dirty(self.dirname)
+        self.failIf(os.path.exists(self.filename1))
+        self.failUnless(os.path.exists(self.filename2))
+        self.failUnlessEqual(saved, [])
+
+    def testNoteStaysDirtyUntilWritten(self):
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        writer = NoteWriter(notelist.note_written)
+        notelist.set_writer(writer)
+        note = notelist.get_notes()[0]
+        note.set_text("yeehaa")
+        notelist.save_dirty(self.dirname)
+        note.set_text("yeehaa again")
+        notelist.flush(5.0)
+        self.failUnless(note.dirty)
+        self.failUnless(notelist.is_dirty())
+        notelist.save_dirty(self.dirname)
+        notelist.flush(5.0)
+        writer.close()
+        self.failIf(note.dirty)
+        self.failIf(notelist.is_dirty())
+        self.failUnlessEqual(read_file(self.filename1), "yeehaa again")
+        entries = Catalog(self.dirname).read()
+        self.failUnlessEqual(entries[self.id1 + ".note"][2], "yeehaa again")
+
     def list_files_only(self, dirname):
         return [x for x in os.listdir(dirname)
-                if os.path.isfile(os.path.join(dirname, x))]
+                if os.path.isfile(os.path.join(dirname, x)) and
+                   x not in [Catalog.FILENAME, Journal.FILENAME]]
 
     def dirs_are_equal(self, dirname1, dirname2):
         files1 = sorted(self.list_files_only(dirname1))
@@ -347,7 +1055,7 @@ class NoteListTests(NoteListTestBase):
         notes = notelist.get_notes()
         self.failUnlessEqual(len(notes), 2)
 
-        notes[0].buffer.set_text("yeehaa")
+        notes[0].get_buffer().set_text("yeehaa")
         notelist.save_dirty(self.dirname + ".new")
 
         files = self.list_files_only(self.dirname)
@@ -376,34 +1084,54 @@ class NoteListTests(NoteListTestBase):
         self.failUnlessEqual(notelist.find_matching(["pretty", "note"]), 
                              [notes[1]])
 
-    def testTooManyVisibilityColumnsException(self):
-        self.failUnless("Exception" not in str(TooManyVisibilityColumns()))
+    def testFindMatchingAfterChange(self):
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        notes = notelist.get_notes()
+        notes[0].set_text("black note")
+        self.failUnlessEqual(notelist.find_matching(["black"]), [notes[0]])
+        self.failUnlessEqual(notelist.find_matching(["pink"]), [])
 
-    def all_visibility_columns_exist(self, notelist):
-        self.failUnlessEqual(sorted(range(notelist.MAX_VISIBILITY_COLUMNS)),
-                             sorted(notelist.visibility_columns +
-                                    notelist.available_visibility_columns))
+    def testFindMatchingAfterRemove(self):
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        notes = notelist.get_notes()
+        notelist.remove_note(None, notes[0])
+        self.failUnlessEqual(notelist.find_matching(["note"]), [notes[1]])
 
     def testAddVisibilityColumn(self):
         notelist = NoteList()
-        self.all_visibility_columns_exist(notelist)
         col = notelist.add_visibility_column()
         self.failUnlessEqual(notelist.get_visibility_columns(), [col])
-        self.all_visibility_columns_exist(notelist)
 
-    def testAddTooManyVisibilityColumns(self):
+    def testManyVisibilityColumns(self):
         notelist = NoteList()
-        for i in range(notelist.MAX_VISIBILITY_COLUMNS):
-            notelist.add_visibility_column()
-        self.failUnlessRaises(TooManyVisibilityColumns,
-                              notelist.add_visibility_column)
+        notelist.load(self.dirname)
+        cols = [notelist.add_visibility_column() for i in range(200)]
+        self.failUnlessEqual(len(set(cols)), 200)
+        notelist.mark_visible_rows(cols[-1], ["pink"])
+        self.failUnlessEqual(notelist.get_visible_notes(cols[-1]),
+                             notelist.find_matching(["pink"]))
+        self.failUnlessEqual(notelist.get_visible_notes(cols[0]), [])
 
     def testRemoveVisibilityColumn(self):
         notelist = NoteList()
         col = notelist.add_visibility_column()
         notelist.remove_visibility_column(col)
         self.failUnlessEqual(notelist.get_visibility_columns(), [])
-        self.all_visibility_columns_exist(notelist)
+        self.failIf(col in notelist.visibility_bits)
+
+    def testRemovedRowSlotIsReusedAsHidden(self):
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        col = notelist.add_visibility_column()
+        notelist.mark_visible_rows(col, [])
+        notelist.remove_note(None, notelist.get_notes()[0])
+        note = Note()
+        note.set_text("black note")
+        notelist.append_note(note)
+        self.failUnlessEqual(notelist.slot_count, 2)
+        self.failIf(note in notelist.get_visible_notes(col))
 
     def testMarkVisibleRows(self):
         notelist = NoteList()
@@ -433,6 +1161,17 @@ class NoteListTests(NoteListTestBase):
         self.failUnlessEqual(notelist.get_visible_notes(col), 
                              notelist.get_notes())
 
+    def testMarkVisibleRowsAfterChangeDuringRefinement(self):
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        notes = notelist.get_notes()
+        col = notelist.add_visibility_column()
+        notelist.mark_visible_rows(col, ["pink"])
+        notes[1].set_text("pink and pretty note")
+        notelist.mark_visible_rows(col, ["pink", "note"])
+        self.failUnlessEqual(sorted(notelist.get_visible_notes(col)),
+                             sorted(notes))
+
     def testDirty(self):
         notelist = NoteList()
         self.failUnlessEqual(notelist.is_dirty(), False)
@@ -450,6 +1189,553 @@ class NoteListTests(NoteListTestBase):
         notelist.make_clean()
         self.failUnlessEqual(notelist.is_dirty(), False)
 
+    def testLoadDoesNotMakeUuids(self):
+        uuid4 = uuid.uuid4
+        def fail():
+            raise AssertionError("uuid4 called")
+        uuid.uuid4 = fail
+        try:
+            notelist = NoteList()
+            notelist.load(self.dirname)
+        finally:
+            uuid.uuid4 = uuid4
+        self.failUnlessEqual(sorted([note.id for note in 
+                                     notelist.get_notes()]),
+                             [self.id1, self.id2])
+
+    def testLoadInParallel(self):
+        notelist = NoteList()
+        notelist.set_load_threads(4)
+        notelist.load(self.dirname)
+        self.failUnlessEqual([note.get_title() for note in 
+                              notelist.get_notes()], 
+                             [self.title1, self.title2])
+        self.failUnlessEqual(notelist.liststore.get_sort_column_id(),
+                             (notelist.TITLE_COLUMN, gtk.SORT_ASCENDING))
+        self.failIf(notelist.is_dirty())
+
+    def testStorageLoadPassesBatches(self):
+        batches = []
+        notes = DirectoryStorage(self.dirname).load(4, batches.append)
+        self.failUnlessEqual(sum(batches, []), notes)
+        self.failUnlessEqual(sorted([note.id for note in notes]), 
+                             [self.id1, self.id2])
+
+    def testLoadTwiceDoesNotDuplicateNotes(self):
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        notelist.load(self.dirname)
+        self.failUnlessEqual(len(notelist.get_notes()), 2)
+
+    def testLoadSameDirectoryUnderOtherName(self):
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        notelist.load(os.path.join(self.dirname, ""))
+        link = self.dirname + "-link"
+        os.symlink(self.dirname, link)
+        try:
+            notelist.load(link)
+        finally:
+            os.remove(link)
+        self.failUnlessEqual(len(notelist.get_notes()), 2)
+
+    def testFilesChangedReplacesCleanNote(self):
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        note = notelist.find_note(self.id1)
+        create_file(self.filename1, "zebra note\n", self.mtime1 + 1)
+        notelist.files_changed(set([self.id1 + ".note"]))
+        self.failUnlessEqual(note.get_text(), "zebra note\n")
+        self.failUnlessEqual(notelist.get_from_title_column(note),
+                             "zebra note")
+        self.failIf(note.dirty)
+        self.failIf(notelist.is_dirty())
+        self.failUnlessEqual(notelist.find_matching(["zebra"]), [note])
+
+    def testFilesChangedKeepsCursorInOpenBuffer(self):
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        note = notelist.find_note(self.id1)
+        buffer = note.get_buffer()
+        buffer.place_cursor(buffer.get_iter_at_offset(3))
+        create_file(self.filename1, "zebra note\n", self.mtime1 + 1)
+        notelist.files_changed(set([self.id1 + ".note"]))
+        self.failUnlessEqual(note.get_text(), "zebra note\n")
+        self.failUnlessEqual(get_mark_offset(note, "insert"), 3)
+        self.failIf(note.dirty)
+
+    def testFilesChangedKeepsDirtyNoteAndAddsDiskVersion(self):
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        note = notelist.find_note(self.id1)
+        note.set_text("yak note\n")
+        create_file(self.filename1, "zebra note\n", self.mtime1 + 1)
+        notelist.files_changed(set([self.id1 + ".note"]))
+        self.failUnlessEqual(note.get_text(), "yak note\n")
+        titles = [n.get_title() for n in notelist.get_notes()]
+        self.failUnlessEqual(sorted(titles),
+                             [self.title2, "yak note", "zebra note"])
+
+    def testFilesChangedAddsCreatedNote(self):
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        filename = os.path.join(self.dirname, "purple.note")
+        create_file(filename, "purple note\n", self.mtime1)
+        try:
+            notelist.files_changed(set(["purple.note"]))
+        finally:
+            os.remove(filename)
+        note = notelist.find_note("purple")
+        self.failUnlessEqual(note.get_title(), "purple note")
+        self.failIf(note.dirty)
+
+    def testFilesChangedRemovesDeletedNote(self):
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        os.remove(self.filename1)
+        notelist.files_changed(None)
+        self.failUnlessEqual([n.id for n in notelist.get_notes()], 
+                             [self.id2])
+        self.failIf(self.id1 + ".note" in Catalog(self.dirname).read())
+
+    def testFilesChangedIgnoresOwnWrites(self):
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        note = notelist.find_note(self.id1)
+        note.set_text("zebra note\n")
+        notelist.save_dirty(self.dirname)
+        notelist.files_changed(set([self.id1 + ".note"]))
+        self.failUnlessEqual(len(notelist.get_notes()), 2)
+        self.failUnlessEqual(note.get_text(), "zebra note\n")
+
+
+class JournalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.journal = Journal(self.dirname)
+        self.note = Note()
+        self.note.set_plain_text("pink\n")
+        self.note.journal_base = md5("pink\n").hexdigest()
+        self.notes = { self.note.id: self.note }
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.dirname)
+
+    def testEmpty(self):
+        self.failUnlessEqual(self.journal.read(), [])
+        self.failUnlessEqual(self.journal.replay(self.notes), {})
+
+    def testReplay(self):
+        self.journal.record(self.note, "insert", 4, " and\tpretty")
+        self.journal.record(self.note, "delete", 0, 5)
+        self.failUnlessEqual(self.journal.replay(self.notes), 
+                             { self.note.id: "and\tpretty\n" })
+
+    def testReplayNonAscii(self):
+        self.journal.record(self.note, "insert", 0, "\xc3\xa4")
+        self.journal.record(self.note, "delete", 1, 2)
+        self.failUnlessEqual(self.journal.replay(self.notes), 
+                             { self.note.id: "\xc3\xa4ink\n" })
+
+    def testSkipsSavedEdits(self):
+        self.journal.record(self.note, "set", "pretty\n")
+        self.note.journal_base = md5("pretty\n").hexdigest()
+        self.journal.record(self.note, "insert", 0, "very ")
+        # The note file already has the first edit.
+        self.note.set_plain_text("pretty\n")
+        self.failUnlessEqual(self.journal.replay(self.notes), 
+                             { self.note.id: "very pretty\n" })
+
+    def testNewAndRemovedNotes(self):
+        new = Note()
+        self.journal.record(new, "set", "black\n")
+        self.journal.record(self.note, "remove")
+        self.failUnlessEqual(self.journal.replay(self.notes), 
+                             { self.note.id: None, new.id: "black\n" })
+
+    def testStopsAtIncompleteLine(self):
+        self.journal.record(self.note, "set", "pretty\n")
+        self.journal.close()
+        f = file(self.journal.filename, "a")
+        f.write("set\t%s" % self.note.id)
+        f.close()
+        self.failUnlessEqual(len(self.journal.read()), 1)
+
+    def testClear(self):
+        self.journal.record(self.note, "set", "pretty\n")
+        self.journal.clear()
+        self.failIf(os.path.exists(self.journal.filename))
+        self.failUnlessEqual(self.journal.replay(self.notes), {})
+
+
+
+class ShardedStorageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.ids = ["abcdef", "abcd99", "ff0011"]
+        for id in self.ids:
+            create_file(os.path.join(self.dirname, id + ".note"), 
+                        id + " note\n", 12765)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def testNotShardedByDefault(self):
+        storage = DirectoryStorage(self.dirname)
+        self.failIf(storage.sharded)
+        self.failUnlessEqual(storage.note_path("abcdef"), "abcdef.note")
+
+    def testShard(self):
+        storage = DirectoryStorage(self.dirname)
+        storage.load()
+        self.failUnlessEqual(storage.shard(), 3)
+        self.failUnless(DirectoryStorage(self.dirname).sharded)
+        self.failUnless(os.path.isfile(os.path.join(self.dirname, "ef", 
+                                                    "cd", "abcdef.note")))
+        self.failUnlessEqual(sorted(Catalog(self.dirname).read().keys()),
+                             [os.path.join("11", "00", "ff0011.note"),
+                              os.path.join("99", "cd", "abcd99.note"),
+                              os.path.join("ef", "cd", "abcdef.note")])
+        notes = DirectoryStorage(self.dirname).load(4)
+        self.failUnlessEqual(sorted([note.id for note in notes]), 
+                             sorted(self.ids))
+        self.failIf([note for note in notes if note.is_loaded()])
+
+    def testLoadFinishesInterruptedShard(self):
+        storage = DirectoryStorage(self.dirname)
+        storage.shard()
+        os.rename(os.path.join(self.dirname, "11", "00", "ff0011.note"),
+                  os.path.join(self.dirname, "ff0011.note"))
+        notes = DirectoryStorage(self.dirname).load()
+        self.failUnlessEqual(sorted([note.id for note in notes]), 
+                             sorted(self.ids))
+        self.failIf(os.path.exists(os.path.join(self.dirname, 
+                                                "ff0011.note")))
+
+    def testTimeOrderedIdsAreSpread(self):
+        storage = DirectoryStorage(self.dirname)
+        storage.shard()
+        shards = set([os.path.dirname(storage.note_path(str(uuid.uuid7())))
+                      for i in range(100)])
+        self.failUnless(len(shards) > 10)
+
+    def testShortIdsStayInTopDirectory(self):
+        for id in ["ab", "x"]:
+            create_file(os.path.join(self.dirname, id + ".note"), 
+                        id + " note\n", 12765)
+        storage = DirectoryStorage(self.dirname)
+        self.failUnlessEqual(storage.shard(), 3)
+        self.failUnlessEqual(storage.note_path("ab"), "ab.note")
+        self.failUnless(os.path.isfile(os.path.join(self.dirname, 
+                                                    "ab.note")))
+        notes = DirectoryStorage(self.dirname).load()
+        self.failUnlessEqual(sorted([note.id for note in notes]), 
+                             sorted(self.ids + ["ab", "x"]))
+
+    def testSaveAndRemoveSharded(self):
+        DirectoryStorage(self.dirname).shard()
+        notelist = NoteList()
+        notelist.load(self.dirname)
+        note = Note()
+        note.id = "123456"
+        note.set_text("new note\n")
+        notelist.append_note(note)
+        notelist.save_dirty(self.dirname)
+        filename = os.path.join(self.dirname, "56", "34", "123456.note")
+        self.failUnlessEqual(read_file(filename), "new note\n")
+        notelist.remove_note(self.dirname, note)
+        self.failIf(os.path.exists(filename))
+
+    def testCommitSyncsShards(self):
+        storage = DirectoryStorage(self.dirname)
+        storage.shard()
+        note = Note()
+        note.id = "123456"
+        note.set_text("new note\n")
+        storage.save_note(note)
+        self.failUnlessEqual(storage.unsynced_dirs, 
+                             set([os.path.join(self.dirname, "56", "34")]))
+        storage.commit()
+        self.failIf(storage.unsynced_dirs)
+
+
+
+class ArchiveTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dirname = os.path.join(self.tempdir, "notes")
+        os.mkdir(self.dirname)
+        create_file(os.path.join(self.dirname, "pink.note"), 
+                    "pink note\n", 12765)
+        create_file(os.path.join(self.dirname, "pretty.note"), 
+                    "pretty note\n", 65535)
+        self.target = os.path.join(self.tempdir, "copy")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def read_target(self):
+        return sorted(read_notes(self.target))
+
+    def testOpenArchive(self):
+        self.failUnless(isinstance(open_archive("x.tar.gz"), TarArchive))
+        self.failUnless(isinstance(open_archive("x.jsonl"), 
+                                   JsonLinesArchive))
+        self.failUnlessEqual(open_archive(self.dirname), None)
+
+    def testTarRoundTrip(self):
+        archive = os.path.join(self.tempdir, "notes.tar.gz")
+        self.failUnlessEqual(stream_notes(self.dirname, archive), (2, 22))
+        self.failUnlessEqual(stream_notes(archive, self.target), (2, 22))
+        self.failUnlessEqual(self.read_target(),
+                             [("pink", 12765, "pink note\n"),
+                              ("pretty", 65535, "pretty note\n")])
+
+    def testJsonLinesRoundTrip(self):
+        if not JsonLinesArchive.available:
+            return
+        archive = os.path.join(self.tempdir, "notes.jsonl")
+        stream_notes(self.dirname, archive)
+        stream_notes(archive, self.target)
+        self.failUnlessEqual(self.read_target(),
+                             [("pink", 12765, "pink note\n"),
+                              ("pretty", 65535, "pretty note\n")])
+
+    def testJsonLinesKeepsNotesThatAreNotUtf8(self):
+        if not JsonLinesArchive.available:
+            return
+        create_file(os.path.join(self.dirname, "pale.note"), 
+                    "p\xe4le note\n", 1)
+        archive = os.path.join(self.tempdir, "notes.jsonl")
+        stream_notes(self.dirname, archive)
+        self.failUnlessEqual(sorted(os.listdir(self.tempdir)),
+                             ["notes", "notes.jsonl"])
+        stream_notes(archive, self.target)
+        self.failUnlessEqual(self.read_target()[0], 
+                             ("pale", 1, "p\xe4le note\n"))
+
+    def testJsonLinesRejectsBadIds(self):
+        if not JsonLinesArchive.available:
+            return
+        archive = os.path.join(self.tempdir, "notes.jsonl")
+        for id in ["", "../escaped", "a/b", ".hidden", "a\nb"]:
+            create_file(archive, json.dumps({"id": id, "mtime": 1, 
+                                             "text": "x"}) + "\n", 1)
+            self.failUnlessRaises(ValueError, stream_notes, archive, 
+                                  self.target)
+        self.failIf(os.path.exists(os.path.join(self.tempdir, 
+                                                "escaped.note")))
+
+    def testTarRejectsBadMemberNames(self):
+        archive = os.path.join(self.tempdir, "notes.tar")
+        tar = tarfile.open(archive, "w")
+        info = tarfile.TarInfo("../escaped.note")
+        info.size = 1
+        tar.addfile(info, StringIO.StringIO("x"))
+        tar.close()
+        self.failUnlessRaises(ValueError, stream_notes, archive, 
+                              self.target)
+        self.failIf(os.path.exists(os.path.join(self.tempdir, 
+                                                "escaped.note")))
+
+    def testFailedExportKeepsArchive(self):
+        archive = os.path.join(self.tempdir, "notes.tar")
+        stream_notes(self.dirname, archive)
+        data = read_file(archive)
+        def notes():
+            yield "pale", 1, "pale note\n"
+            raise IOError("disk full")
+        self.failUnlessRaises(IOError, TarArchive(archive).write, notes())
+        self.failUnlessEqual(read_file(archive), data)
+        self.failUnlessEqual(sorted(os.listdir(self.tempdir)),
+                             ["notes", "notes.tar"])
+
+    def testImportKeepsOtherNotes(self):
+        os.mkdir(self.target)
+        create_file(os.path.join(self.target, "pale.note"), 
+                    "pale note\n", 1)
+        stream_notes(self.dirname, self.target)
+        self.failUnlessEqual([note[0] for note in self.read_target()],
+                             ["pale", "pink", "pretty"])
+        self.failUnlessEqual(sorted(Catalog(self.target).read().keys()),
+                             ["pink.note", "pretty.note"])
+
+
+class SqliteStorageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, "notes.sqlite")
+        if not SqliteStorage.available:
+            return
+        self.storage = SqliteStorage(self.filename)
+        self.notes = []
+        for text in ["pink note", "pretty note", "black"]:
+            note = Note()
+            note.set_text(text)
+            self.storage.save_note(note)
+            self.notes.append(note)
+        self.storage.commit()
+
+    def tearDown(self):
+        if SqliteStorage.available:
+            self.storage.close()
+        shutil.rmtree(self.dirname)
+
+    def testOpenStorage(self):
+        self.failUnless(isinstance(open_storage(self.filename), 
+                                   SqliteStorage))
+        self.failUnless(isinstance(open_storage(self.dirname), 
+                                   DirectoryStorage))
+
+    def testLoad(self):
+        if not SqliteStorage.available:
+            return
+        storage = SqliteStorage(self.filename)
+        notes = storage.load()
+        storage.close()
+        self.failUnlessEqual(sorted([(n.id, n.get_text(), n.mtime)
+                                     for n in notes]),
+                             sorted([(n.id, n.get_text(), n.mtime)
+                                     for n in self.notes]))
+        self.failIf(self.notes[0].dirty)
+
+    def find(self, pattern):
+        return sorted(self.storage.find(pattern))
+
+    def ids(self, notes):
+        return sorted([note.id for note in notes])
+
+    def testFind(self):
+        if not SqliteStorage.available:
+            return
+        self.failUnlessEqual(self.find([]), self.ids(self.notes))
+        self.failUnlessEqual(self.find(["note"]), self.ids(self.notes[:2]))
+        self.failUnlessEqual(self.find(["ink"]), self.ids(self.notes[:1]))
+        self.failUnlessEqual(self.find(["e"]), self.ids(self.notes[:2]))
+        self.failUnlessEqual(self.find(["!note"]), self.ids(self.notes[2:]))
+        self.failUnlessEqual(self.find(["note", "!pink"]), 
+                             self.ids(self.notes[1:2]))
+        self.failUnlessEqual(self.find(['"quoted']), [])
+
+    def testRemove(self):
+        if not SqliteStorage.available:
+            return
+        self.storage.remove_note(self.notes[0])
+        self.storage.commit()
+        self.failUnlessEqual(self.find(["pink"]), [])
+        self.failUnlessEqual(len(self.storage.load()), 2)
+
+    def testSearchIndex(self):
+        if not SqliteStorage.available:
+            return
+        index = self.storage.get_search_index()
+        if index is None:
+            return
+        for note in self.notes:
+            index.add_note(note)
+        self.failUnlessEqual(index.find(["note"]), set(self.notes[:2]))
+        # Unsaved changes are found, too.
+        self.notes[2].set_text("black note")
+        index.update_note(self.notes[2])
+        self.failUnlessEqual(index.find(["note"]), set(self.notes))
+        self.failUnlessEqual(index.find(["note"], set(self.notes[1:])), 
+                             set(self.notes[1:]))
+        index.remove_note(self.notes[0])
+        self.failUnlessEqual(index.find(["pink"]), set())
+
+
+class NoteWriterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, "pink.note")
+        self.written = []
+        self.writer = NoteWriter(self.remember)
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.dirname)
+
+    def remember(self, *args):
+        self.written.append(args)
+
+    def testSave(self):
+        self.writer.save(self.filename, "pink\n", 12765, "data")
+        self.failUnless(self.writer.drain(5.0))
+        self.failUnless(self.writer.is_idle())
+        self.failUnlessEqual(read_file(self.filename), "pink\n")
+        self.failUnlessEqual(os.stat(self.filename).st_mtime, 12765)
+        self.failUnlessEqual(len(self.written), 1)
+        filename, data, digest, st = self.written[0]
+        self.failUnlessEqual(filename, self.filename)
+        self.failUnlessEqual(data, "data")
+        self.failUnlessEqual(st.st_mtime, 12765)
+
+    def testCoalescesSaves(self):
+        # Holding the lock keeps the thread from taking the first save
+        # off the queue before the second one is added.
+        self.writer.condition.acquire()
+        self.writer.save(self.filename, "pink\n", 12765, 1)
+        self.writer.save(self.filename, "pretty\n", 12766, 2)
+        self.writer.condition.release()
+        self.writer.drain(5.0)
+        self.failUnlessEqual(read_file(self.filename), "pretty\n")
+        self.failUnlessEqual([args[1] for args in self.written], [2])
+
+    def testRemove(self):
+        self.writer.save(self.filename, "pink\n", 12765, None)
+        self.writer.remove(self.filename)
+        self.writer.drain(5.0)
+        self.failIf(os.path.exists(self.filename))
+
+
+
+class WatcherTests(NoteListTestBase):
+
+    def setUp(self):
+        NoteListTestBase.setUp(self)
+        self.changes = []
+
+    def callback(self, basenames):
+        self.changes.append(basenames)
+
+    def testPollingWatcher(self):
+        watcher = PollingWatcher(self.dirname, self.callback)
+        watcher.finish_scan()
+        self.failUnlessEqual(self.changes, [])
+        create_file(self.filename1, "zebra note\n", self.mtime1 + 1)
+        os.remove(self.filename2)
+        watcher.poll()
+        watcher.finish_scan()
+        watcher.close()
+        self.failUnlessEqual(self.changes, 
+                             [set([self.id1 + ".note", self.id2 + ".note"])])
+
+    def testPollingWatcherSkipsUnchangedDirectory(self):
+        os.utime(self.dirname, (self.mtime1, self.mtime1))
+        watcher = PollingWatcher(self.dirname, self.callback)
+        watcher.finish_scan()
+        watcher.poll()
+        self.failUnlessEqual(watcher.steps, None)
+        watcher.ticks = watcher.FULL_SCAN_EVERY - 1
+        watcher.poll()
+        self.failIfEqual(watcher.steps, None)
+        watcher.close()
+
+    def testInotifyWatcher(self):
+        if get_inotify() is None:
+            return
+        watcher = InotifyWatcher(self.dirname, self.callback)
+        create_file(self.filename1, "zebra note\n", self.mtime1 + 1)
+        watcher.read_events(watcher.fd, gobject.IO_IN)
+        watcher.close()
+        self.failUnlessEqual(self.changes, [set([self.id1 + ".note"])])
+
 
 class AppTests(NoteListTestBase):
 
@@ -474,6 +1760,13 @@ class AppTests(NoteListTestBase):
         app.open_notelist(self.dirname)
         self.failUnlessEqual(len(app.notelist.get_notes()), 2)
         self.failUnlessEqual(app.dirname, self.dirname)
+        self.failIfEqual(app.watcher, None)
+
+    def testOpenNoteListTwice(self):
+        app = App()
+        app.open_notelist(self.dirname)
+        app.open_notelist(self.dirname)
+        self.failUnlessEqual(len(app.notelist.get_notes()), 2)
 
     def testDirnameNotSetException(self):
         self.failIf("Exception" in str(DirnameNotSet()))
@@ -501,9 +1794,28 @@ class AppTests(NoteListTestBase):
         notes[0].now = lambda: 1999
         notes[0].touch()
         app.autosave_notelist()
+        app.notelist.flush(5.0)
         filename = os.path.join(self.dirname, notes[0].id + ".note")
         self.failUnlessEqual(os.stat(filename).st_mtime, 1999)
 
+    def testAutoSaveWritesOnlyDirtyNotes(self):
+        app = App()
+        app.open_notelist(self.dirname)
+        notes = app.notelist.get_notes()
+        written = []
+        writer = app.notelist.writer
+        def write(filename, job, original=writer.write):
+            written.append(filename)
+            return original(filename, job)
+        writer.write = write
+        notes[0].touch()
+        app.autosave_notelist()
+        app.notelist.flush(5.0)
+        self.failUnlessEqual(written, [self.filename1])
+        app.autosave_notelist()
+        app.notelist.flush(5.0)
+        self.failUnlessEqual(written, [self.filename1])
+
     def testSaveNoteList(self):
         app = App()
         app.open_notelist(self.dirname)
@@ -511,6 +1823,7 @@ class AppTests(NoteListTestBase):
         notes[0].now = lambda: 1999
         notes[0].touch()
         app.save_notelist()
+        app.notelist.flush(5.0)
         filename = os.path.join(self.dirname, notes[0].id + ".note")
         self.failUnlessEqual(os.stat(filename).st_mtime, 1999)
 
@@ -559,6 +1872,27 @@ class WindowTests(NoteListTestBase):
         self.failUnlessEqual(w.selected_note, None)
         self.failIfEqual(w.textview, None)
 
+    def testWindowsShareGladeFile(self):
+        app = App()
+        w1 = app.new_window()
+        buffer = app.glade_buffer
+        w2 = app.new_window()
+        self.failUnless(app.glade_buffer is buffer)
+        self.failIf(w1.window is w2.window)
+
+    def testDialogsAreCreatedOnFirstUse(self):
+        app = App()
+        w = app.new_window()
+        self.failUnlessEqual(w.open_dialog, None)
+        self.failUnlessEqual(w.delete_dialog, None)
+        w.create_open_dialog()
+        dialog = w.open_dialog
+        self.failIfEqual(dialog, None)
+        w.create_open_dialog()
+        self.failUnless(w.open_dialog is dialog)
+        w.create_delete_dialog()
+        self.failIfEqual(w.delete_label, None)
+
     def app_has_quit(self):
         self.app_quits += 1
 
@@ -608,6 +1942,7 @@ class DeleteNoteTests(NoteListTestBase):
         dialog.response(gtk.RESPONSE_OK)
 
     def testDeleteNoteWhenOneIsSelected(self):
+        self.w.create_delete_dialog()
         self.w.delete_dialog.connect("expose-event", self.close_delete_dialog)
 
         notes1 = self.app.notelist.get_notes()
@@ -619,6 +1954,7 @@ class DeleteNoteTests(NoteListTestBase):
 
     def testDeleteWhenDirNotOpened(self):
         self.w.app.dirname = None
+        self.w.create_delete_dialog()
         self.w.delete_dialog.connect("expose-event", self.close_delete_dialog)
 
         notes1 = self.app.notelist.get_notes()
@@ -765,6 +2101,14 @@ class StatusInfoTests(unittest.TestCase):
         self.failUnlessEqual(self.si.match_count, 12765)
         self.failIfEqual(self.si.widget.get_text(), "")
 
+    def testSetPartialMatchCount(self):
+        self.si.set_match_count(12, searching=True)
+        self.failUnless(self.si.searching)
+        text = self.si.widget.get_text()
+        self.si.set_match_count(12)
+        self.failIf(self.si.searching)
+        self.failIfEqual(self.si.widget.get_text(), text)
+
 
 class RefilterUpdatesCountInStatus(NoteListTestBase):
 
@@ -788,6 +2132,71 @@ class RefilterUpdatesCountInStatus(NoteListTestBase):
         self.failUnlessEqual(w.status.match_count, 1)
 
 
+class IncrementalSearchTests(NoteListTestBase):
+
+    def setUp(self):
+        NoteListTestBase.setUp(self)
+        self.app = App()
+        self.app.open_notelist(self.dirname)
+        self.app.notelist.ROWS_PER_STEP = 1
+        self.w = self.app.new_window()
+        self.w.SEARCH_TIME_SLICE = 0
+
+    def tearDown(self):
+        self.w.stop_search()
+        NoteListTestBase.tearDown(self)
+
+    def finish_search(self):
+        while self.w.continue_search():
+            pass
+
+    def testSearchContinuesFromIdleCallback(self):
+        self.w.set_search_pattern(["pink"])
+        self.failIfEqual(self.w.search_job, None)
+        self.failIfEqual(self.w.search_idle_id, None)
+        self.failUnless(self.w.status.searching)
+        self.finish_search()
+        self.failUnlessEqual(self.w.search_job, None)
+        self.failUnlessEqual(self.w.search_idle_id, None)
+        self.failIf(self.w.status.searching)
+        self.failUnlessEqual(self.w.status.get_match_count(), 1)
+
+    def testNewSearchCancelsOldOne(self):
+        self.w.set_search_pattern(["pink"])
+        old_job = self.w.search_job
+        self.w.set_search_pattern(["pretty"])
+        self.failIf(self.w.search_job is old_job)
+        self.finish_search()
+        self.failUnlessEqual(self.w.get_matching_notes(),
+                             self.app.notelist.find_matching(["pretty"]))
+
+    def testSearchRestartsWhenRowsChange(self):
+        self.w.set_search_pattern(["pink"])
+        note = Note()
+        note.set_text("a new pink note")
+        self.app.notelist.append_note(note)
+        self.finish_search()
+        self.failUnlessEqual(len(self.w.get_matching_notes()), 2)
+
+    def testCloseCancelsSearch(self):
+        self.app.quit = lambda: None
+        self.w.set_search_pattern(["pink"])
+        self.w.close()
+        self.failUnlessEqual(self.w.search_job, None)
+
+    def testOnlyChangedRowsAreTouched(self):
+        changed = []
+        self.app.notelist.liststore.connect("row-changed",
+            lambda model, path, iter: changed.append(path))
+        self.w.set_search_pattern(["note"])
+        self.finish_search()
+        self.failUnlessEqual(changed, [])
+        self.w.set_search_pattern(["pink"])
+        self.finish_search()
+        self.failUnlessEqual(len(changed), 1)
+        self.failUnlessEqual(self.w.status.get_match_count(), 1)
+
+
 class SelectedNoteTests(NoteListTestBase):
 
     def testNoInitialNote(self):
@@ -979,6 +2388,7 @@ class FileMenuTests(NoteListTestBase):
     def testSave(self):
         self.w.on_cut_activate()
         self.w.on_save_activate()
+        self.app.notelist.flush(5.0)
         self.failUnlessEqual(self.note.dirty, False)
 
     def choose(self, dialog, *args):
@@ -989,6 +2399,7 @@ class FileMenuTests(NoteListTestBase):
         app = App()
         w = app.new_window()
         self.chosen = self.dirname
+        w.create_open_dialog()
         w.open_dialog.select_filename(self.chosen)
         w.open_dialog.connect("selection-changed", self.choose)
         w.on_open_activate()
@@ -1009,6 +2420,7 @@ class FileMenuTests(NoteListTestBase):
         app = App()
         w = app.new_window()
         self.chosen = tempfile.mkdtemp()
+        w.create_save_as_dialog()
         w.save_as_dialog.select_filename(self.chosen)
         w.save_as_dialog.connect("selection-changed", self.choose)
         w.on_save_as_activate()
@@ -0,0 +1,100 @@
+#!/usr/bin/python2.4
+#
+# Copyright (C) 2007  Lars Wirzenius <liw@iki.fi>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Measure how fast notetakuuid makes and formats UUIDs
+
+Usage: uuidbench.py [COUNT]
+
+Each operation is timed COUNT times (default 100000) with the fast
+paths of notetakuuid, and with the way the UUID class used to do it,
+which is reproduced here, or one UUID at a time.
+
+"""
+
+import os
+import sys
+import time
+
+import notetakuuid
+
+
+def old_int_from_bytes(bytes):
+    return long(('%02x'*16) % tuple(map(ord, bytes)), 16)
+
+
+def old_bytes_from_int(int):
+    bytes = ''
+    for shift in range(0, 128, 8):
+        bytes = chr((int >> shift) & 0xff) + bytes
+    return bytes
+
+
+def old_str(int):
+    hex = '%032x' % int
+    return '%s-%s-%s-%s-%s' % (
+        hex[:8], hex[8:12], hex[12:16], hex[16:20], hex[20:])
+
+
+def measure(func, count):
+    """Return the number of seconds it takes to call func count times"""
+    started = time.time()
+    for i in xrange(count):
+        func()
+    return time.time() - started
+
+
+def main():
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    else:
+        count = 100000
+    u = notetakuuid.uuid4()
+    bytes = u.bytes
+    buffer = os.urandom(16 * 1000)
+    cases = [
+        ("UUID from bytes",
+         lambda: old_int_from_bytes(bytes),
+         lambda: notetakuuid.UUID(bytes=bytes)),
+        ("bytes from UUID",
+         lambda: old_bytes_from_int(u.int),
+         lambda: u.bytes),
+        ("str(UUID)",
+         lambda: old_str(u.int),
+         lambda: str(u)),
+        ("1000 UUIDs from one buffer",
+         lambda: [notetakuuid.UUID(int=old_int_from_bytes(buffer[i:i+16]))
+                  for i in range(0, len(buffer), 16)],
+         lambda: notetakuuid.uuids_from_bytes(buffer)),
+        ("1000 random UUIDs",
+         lambda: [notetakuuid.uuid4() for i in range(1000)],
+         lambda: notetakuuid.uuid4_batch(1000)),
+        ]
+    print "%-28s %10s %10s %8s" % ("operation", "old (s)", "new (s)", 
+                                   "speedup")
+    for name, old, new in cases:
+        n = count
+        if name.startswith("1000"):
+            n = max(1, count / 1000)
+        old_time = measure(old, n)
+        new_time = max(measure(new, n), 1e-9)
+        print "%-28s %10.3f %10.3f %7.1fx" % (name, old_time, new_time, 
+                                              old_time / new_time)
+
+
+if __name__ == "__main__":
+    main()